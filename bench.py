@@ -0,0 +1,218 @@
+"""Benchmarks for program, run on a made-up corpus of any size
+
+The corpus is written to a temporary directory, loaded the same way the
+CLI and GUI load the real one, and then timed:
+    - parsing all .story and .words files
+    - checking compatibility between every story and word list
+    - compiling every compatible pair into a render plan
+    - rendering stories, as latency percentiles for a single story
+    - peak memory used while loading
+    - memory saved by sharing words between word lists
+
+Results are printed as JSON, so they can be saved and compared between
+commits. Run "python bench.py --help" to see all of the options.
+"""
+
+import story_circus as sc
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+
+def makeCorpus(directory, args):
+    """Write a made-up corpus into directory, following the options in args.
+
+    Every word list declares each label in the pool with most of its
+    sublabels, so some stories and word lists fit together and some do not.
+    """
+    rng = random.Random(args.seed)
+    pool = ["Label%i" % i for i in range(args.label_pool)]
+    sublabels = ["Sub%i" % i for i in range(args.sublabels)]
+
+    for i in range(args.wordlists):
+        lines = ["Word List %i" % i, ""]
+        for label in pool:
+            if rng.random() < 0.1:
+                continue
+            lines.append("/".join([label] + sublabels))
+            for option in range(args.options):
+                words = [label.lower() + str(option)]
+                for sublabel in sublabels:
+                    words.append("%s%i" % (sublabel.lower(), option))
+                lines.append("\t" + "/".join(words))
+            lines.append("")
+        writeFile(directory, "bench%05i.words" % i, lines)
+
+    for i in range(args.stories):
+        labels = rng.sample(pool, min(args.labels, len(pool)))
+        sections = []
+        for j in range(args.length):
+            label = rng.choice(labels)
+            if rng.random() < args.id_density:
+                label += ":%i" % rng.randint(1, min(args.ids, args.options))
+                if sublabels and rng.random() < 0.5:
+                    label += "/" + rng.choice(sublabels)
+            sections.append("some plain text {%s}" % label)
+        writeFile(directory, "bench%05i.story" % i,
+                  ["Story %i" % i, "", " ".join(sections) + "."])
+
+
+def writeFile(directory, name, lines):
+    """Write lines of text to a file."""
+    with open(os.path.join(directory, name), 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def percentiles(times, points=(50, 90, 99)):
+    """Get the given percentiles of a list of times, in microseconds."""
+    times = sorted(times)
+    results = {}
+    for point in points:
+        i = min(len(times) - 1, int(len(times) * point / 100))
+        results["p%i" % point] = round(times[i] * 1e6, 2)
+    return results
+
+
+def run(args):
+    """Run every benchmark on a new corpus. Return the results."""
+    results = {"options": vars(args)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        makeCorpus(directory, args)
+        sc.STORY_DIR = sc.WORDS_DIR = directory + os.sep
+        size = sum(
+            os.path.getsize(os.path.join(directory, file))
+            for file in os.listdir(directory)
+        )
+
+        # Parsing. Memory is traced on a second load, since tracing is slow.
+        start = time.perf_counter()
+        recipes = sc.loadStoryRecipes()
+        middle = time.perf_counter()
+        wordlists = sc.loadWordLists()
+        end = time.perf_counter()
+
+        tracemalloc.start()
+        sc.loadStoryRecipes()
+        sc.loadWordLists()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results["parse"] = {
+            "files": len(recipes) + len(wordlists),
+            "bytes": size,
+            "story_seconds": round(middle - start, 6),
+            "words_seconds": round(end - middle, 6),
+            "files_per_second": round(
+                (len(recipes) + len(wordlists)) / (end - start), 1
+            ),
+            "megabytes_per_second": round(size / (end - start) / 1e6, 2),
+        }
+        results["peak_memory_bytes"] = peak
+
+        # Sharing words between wordlists, as the Corpus does.
+        tracemalloc.start()
+        unshared = sc.loadWordLists()
+        unshared_bytes = tracemalloc.get_traced_memory()[0]
+        del unshared
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        pool = sc.WordPool()
+        shared = sc.loadWordLists(pool = pool)
+        shared_bytes = tracemalloc.get_traced_memory()[0]
+        del shared
+        tracemalloc.stop()
+
+        results["sharing"] = {
+            "unshared_bytes": unshared_bytes,
+            "shared_bytes": shared_bytes,
+            "saved_bytes": pool.saved,
+            "words": len(pool.words),
+            "columns": len(pool.columns),
+        }
+
+        # Compatibility.
+        start = time.perf_counter()
+        sc.checkStoryCompatibilities(recipes, wordlists)
+        end = time.perf_counter()
+        pairs = sum(len(recipe.safe_wordlists) for recipe in recipes)
+        results["compatibility"] = {
+            "seconds": round(end - start, 6),
+            "compatible_pairs": pairs,
+        }
+
+        # Compiling every compatible pair, so rendering times are steady.
+        pairs = [
+            (recipe, wordlists[i])
+            for recipe in recipes for i in recipe.safe_wordlists
+        ]
+        start = time.perf_counter()
+        for recipe, wordlist in pairs:
+            recipe.compile(wordlist)
+        results["compile_seconds"] = round(time.perf_counter() - start, 6)
+
+        # Rendering, cycling through every compatible pair.
+        times = []
+        if pairs:
+            for i in range(args.renders):
+                recipe, wordlist = pairs[i % len(pairs)]
+                start = time.perf_counter()
+                story = sc.Story(recipe, wordlist)
+                story.generate()
+                times.append(time.perf_counter() - start)
+        results["render_microseconds"] = percentiles(times) if times else {}
+        results["renders_per_second"] = \
+            round(len(times) / sum(times), 1) if times else 0
+
+    return results
+
+
+def parseArgs():
+    """Read the command line options."""
+    parser = argparse.ArgumentParser(description = "Story Circus benchmarks")
+    options = [
+        ("--stories", 200, "number of .story files"),
+        ("--wordlists", 200, "number of .words files"),
+        ("--label-pool", 40, "number of different labels in the corpus"),
+        ("--labels", 8, "number of labels used in each story"),
+        ("--sublabels", 2, "number of sublabels for each label"),
+        ("--options", 100, "number of word options for each label"),
+        ("--ids", 5, "highest id used in a story for each label"),
+        ("--length", 200, "number of labels in each story"),
+        ("--renders", 20000, "number of stories to render"),
+        ("--seed", 1, "seed for making the corpus"),
+    ]
+    for flag, default, text in options:
+        parser.add_argument(
+            flag, type = int, default = default,
+            help = "%s, default is %i" % (text, default)
+        )
+    parser.add_argument(
+        "--id-density", type = float, default = 0.5,
+        help = "share of story labels which have an id, default is 0.5"
+    )
+    parser.add_argument(
+        "--output", metavar = "FILE",
+        help = "write the results to FILE as well as printing them"
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks, then print and save the results."""
+    args = parseArgs()
+    results = run(args)
+    text = json.dumps(results, indent = 2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 """Command Line Interface for program"""
 
 import story_circus as sc
+import argparse
 import os
+import sys
 
 # Game modes.
 # The values are displayed to and selected by the user after each story.
@@ -10,29 +12,122 @@ REPLAY   = "Listen to the same story again"
 QUIT     = "That's all for now"
 
 
-def main():
-    """Main program loop."""
+def main(bundle=None):
+    """Main program loop, reading stories from a bundle file if given."""
     Welcome()
     waitForEnter()
 
-    recipes = sc.loadStoryRecipes()
-    wordlists = sc.loadWordLists()
-    sc.checkStoryCompatibilities(recipes, wordlists)
+    corpus = sc.Corpus(lazy = True, bundle = bundle)
+    recipes = corpus.recipes
+    wordlists = corpus.wordlists
+
+    # Stories rendered ahead of time, for each story and word list picked.
+    buffers = {}
 
     mode = NEW_GAME
     while mode != QUIT:
 
         if mode == NEW_GAME:
+            # Pick up any stories that were added or changed in the meantime.
+            if corpus.refresh():
+                sc.closeStaleBuffers(buffers, recipes, wordlists)
             recipe = pickStoryRecipe(recipes)
             wordlist = pickWordList(wordlists, recipe)
+            if (recipe, wordlist) not in buffers:
+                buffers[recipe, wordlist] = sc.StoryBuffer(recipe, wordlist)
 
-        story = sc.Story(recipe, wordlist)
-        story.generate()
+        story = buffers[recipe, wordlist].pop()
         display(story)
         waitForEnter()
 
         mode = getNextMode()
 
+def bulk(args):
+    """Generate many stories without asking anything, and print them all.
+
+    The story and word list are picked by the numbers shown in the menus.
+    Stories are separated by a blank line.
+    """
+    corpus = sc.Corpus(bundle = args.bundle)
+    recipes = corpus.recipes
+    wordlists = corpus.wordlists
+
+    if not 1 <= args.story <= len(recipes):
+        sys.exit("There is no story number %i." % args.story)
+    recipe_id = args.story - 1
+    safe = recipes[recipe_id].safe_wordlists
+    if not 1 <= args.words <= len(safe):
+        sys.exit("There is no word list number %i for that story." % args.words)
+    wordlist_id = safe[args.words - 1]
+
+    # Unique stories are unranked one by one, so no story is printed twice.
+    if args.unique:
+        plan = recipes[recipe_id].compile(wordlists[wordlist_id])
+        try:
+            count = plan.storyCount()
+        except ValueError as error:
+            sys.exit(str(error))
+        if args.bulk > count:
+            sys.exit("That story only has %i different versions." % count)
+        for story in plan.iterUnique(args.bulk, args.seed):
+            sys.stdout.write(story + "\n\n")
+        return
+
+    with sc.BulkGenerator(
+        recipes, wordlists, args.workers, args.chunk_size
+    ) as generator:
+        for chunk in generator.generate(
+            recipe_id, wordlist_id, args.bulk, args.seed
+        ):
+            sys.stdout.write("\n\n".join(chunk) + "\n\n")
+
+
+def parseArgs():
+    """Read the command line options."""
+    parser = argparse.ArgumentParser(description = "Story Circus")
+    parser.add_argument(
+        "--bulk", type = int, metavar = "COUNT",
+        help = "print COUNT stories without asking anything, then exit"
+    )
+    parser.add_argument(
+        "--story", type = int, default = 1, metavar = "NUMBER",
+        help = "story number from the story menu, for --bulk"
+    )
+    parser.add_argument(
+        "--words", type = int, default = 1, metavar = "NUMBER",
+        help = "word list number from the word list menu, for --bulk"
+    )
+    parser.add_argument(
+        "--seed", type = int,
+        help = "seed for --bulk, the same seed gives the same stories"
+    )
+    parser.add_argument(
+        "--workers", type = int,
+        help = "number of processes for --bulk, default is one per core"
+    )
+    parser.add_argument(
+        "--chunk-size", type = int, default = 1000, metavar = "COUNT",
+        help = "stories per task for --bulk, part of what --seed repeats"
+    )
+    parser.add_argument(
+        "--unique", action = "store_true",
+        help = "never print the same story twice with --bulk"
+    )
+    parser.add_argument(
+        "--bundle", metavar = "FILE",
+        help = "read the stories from a bundle FILE instead of data/"
+    )
+    parser.add_argument(
+        "--build-bundle", metavar = "FILE",
+        help = "pack the files in data/ into a bundle FILE, then exit"
+    )
+    parser.add_argument(
+        "--stats", action = "store_true",
+        help = "print where the time went when finished"
+    )
+    return parser.parse_args()
+
+
 def Welcome():
     """Display the title splash, and explain the program to the user."""
     print("Story Circus", sc.__version__, "by", sc.__author__)
@@ -46,7 +141,9 @@ def pickStoryRecipe(recipes):
     clearScreen()
     print("Choose the story you would like to hear.")
     names = map(lambda r: r.name, recipes)
-    return recipes[pickFromList(names)]
+    recipe = recipes[pickFromList(names)]
+    recipe.load()
+    return recipe
 
 
 def pickWordList(wordlists, recipe):
@@ -58,7 +155,9 @@ def pickWordList(wordlists, recipe):
         ids.append(i)
         names.append(wordlists[i].name)
     choice = pickFromList(names)
-    return wordlists[ids[choice]]
+    wordlist = wordlists[ids[choice]]
+    wordlist.load()
+    return wordlist
 
 
 def getNextMode():
@@ -123,4 +222,18 @@ def clearScreen():
         os.system('clear')
 
 if __name__ == "__main__":
-    main()
+    args = parseArgs()
+    if args.stats:
+        sc.enableStats()
+
+    if args.build_bundle is not None:
+        count = sc.buildBundle(args.build_bundle)
+        print("Packed %i files into %s" % (count, args.build_bundle))
+    elif args.bulk is None:
+        main(args.bundle)
+    else:
+        bulk(args)
+
+    # Stats go to stderr, so they stay out of any stories being saved.
+    if args.stats:
+        print(sc.getStats().report(), file = sys.stderr)
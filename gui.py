@@ -1,7 +1,9 @@
 """Graphical User Interface for program using Tkinter"""
 
 import os
+import queue
 import story_circus as sc
+import threading
 import tkinter as tk
 import tkinter.scrolledtext as st
 
@@ -16,6 +18,12 @@ BUTTON_FG = "#202020"           # default foreground color for menu buttons
 BUTTON_ALT = "#404040"          # highlight background color for menu buttons
 BUTTON_PAD = "5px"              # padding used between grouped buttons
 
+RELOAD_DELAY = 1000             # milliseconds between checks for new files
+LOAD_DELAY = 50                 # milliseconds between checks while loading
+
+TEXT_CHUNK = 2000               # characters of story shown at a time
+INSERT_DELAY = 1                # milliseconds between showing each chunk
+
 
 class Root:
     """Root window, used for splash screen and story menu."""
@@ -24,7 +32,7 @@ class Root:
         """Create the root window and launch main function."""
         self.w = tk.Tk()
         self.w.title("Story Circus " + sc.__version__)
-        self.w.after(1, self.main())
+        self.w.after(1, self.main)
         self.w.mainloop()
 
     def main(self):
@@ -32,11 +40,134 @@ class Root:
         self.title = tk.Label(self.w, font = TITLE_FONT)
         self.title.pack(padx = TITLE_PAD, pady = TITLE_PAD)
 
+        # Add label for showing how much of the story data has loaded.
+        self.status = tk.Label(self.w, font = TEXT_FONT)
+        self.status.pack()
+
         self.splash()
 
-        self.recipes = sc.loadStoryRecipes()
-        self.wordlists = sc.loadWordLists()
-        sc.checkStoryCompatibilities(self.recipes, self.wordlists)
+        # Stories and word lists are added here as they finish loading.
+        self.corpus = None
+        self.recipes = []
+        self.wordlists = []
+
+        # No menu is shown until the user clicks Start.
+        self.page = None
+
+        # Stories rendered ahead of time, for each story and word list picked.
+        self.buffers = {}
+
+        # Load the story data in another thread, so this window never freezes.
+        self.loaded = queue.Queue()
+        threading.Thread(target = self.__load, daemon = True).start()
+        self.w.after(LOAD_DELAY, self.__checkLoading)
+
+    def __load(self):
+        """Load the story data. Runs in its own thread, so never touches Tk.
+
+        Each loaded file is put in self.loaded as (done, total, item).
+        At the end, the whole corpus is put in as (None, None, corpus), or
+        the error that stopped it as (None, None, error).
+        """
+        def progress(done, total, item):
+            self.loaded.put((done, total, item))
+
+        try:
+            corpus = sc.Corpus(lazy = True, progress = progress)
+        except Exception as error:
+            self.loaded.put((None, None, error))
+        else:
+            self.loaded.put((None, None, corpus))
+
+    def __checkLoading(self):
+        """Show the files loaded so far, and check again soon if not done."""
+        new_recipes = []
+        finished = False
+        while not self.loaded.empty():
+            done, total, item = self.loaded.get()
+
+            if isinstance(item, sc.WordList):
+                self.wordlists.append(item)
+            elif isinstance(item, sc.StoryRecipe):
+                self.recipes.append(item)
+                new_recipes.append(item)
+            elif isinstance(item, sc.Corpus):
+                self.__finishLoading(item)
+                finished = True
+            else:
+                self.status.config(text = "Could not load stories: %s" % item)
+                finished = True
+
+            if done != None:
+                self.status.config(
+                    text = "Loading stories... %i of %i" % (done, total)
+                )
+
+        # Add the new stories to the menu, if it is showing.
+        if self.page == 1:
+            for recipe in new_recipes:
+                self.__addOption(recipe.name, self.__setRecipe)
+
+        if not finished:
+            self.w.after(LOAD_DELAY, self.__checkLoading)
+
+    def __finishLoading(self, corpus):
+        """Switch over to the fully loaded corpus, and watch for changes."""
+        self.corpus = corpus
+        self.recipes = corpus.recipes
+        self.wordlists = corpus.wordlists
+        self.status.config(text = "")
+        self.status.pack_forget()
+        self.w.after(RELOAD_DELAY, self.__reload)
+
+    def getStoryBuffer(self):
+        """Get the StoryBuffer for the chosen recipe and wordlist."""
+        key = (self.recipe, self.wordlist)
+        if key not in self.buffers:
+            self.buffers[key] = sc.StoryBuffer(self.recipe, self.wordlist)
+        return self.buffers[key]
+
+    def __reload(self):
+        """Check for changed data files in another thread, then wait for it."""
+        self.reloaded = queue.Queue()
+        threading.Thread(target = self.__refresh, daemon = True).start()
+        self.w.after(LOAD_DELAY, self.__checkReload)
+
+    def __refresh(self):
+        """Read changed files. Runs in its own thread, so never touches Tk.
+
+        The corpus update is put in self.reloaded, None if nothing changed,
+        or the error that stopped it. The corpus itself is not changed here,
+        the update is applied by __checkReload.
+        """
+        try:
+            update = self.corpus.prepareRefresh()
+        except Exception as error:
+            self.reloaded.put(error)
+        else:
+            self.reloaded.put(update)
+
+    def __checkReload(self):
+        """Switch to the changed data files, once they have been read.
+
+        The update is applied here, on the Tk thread, so a menu never sees
+        the recipes and wordlists half switched over.
+        """
+        if self.reloaded.empty():
+            self.w.after(LOAD_DELAY, self.__checkReload)
+            return
+
+        update = self.reloaded.get()
+        if isinstance(update, Exception):
+            # Let Tk report it. Files are not watched after that.
+            raise update
+        if update is not None:
+            self.corpus.applyRefresh(update)
+            sc.closeStaleBuffers(self.buffers, self.recipes, self.wordlists)
+            if self.page != None:
+                # The chosen story might be gone, so start the menu over.
+                self.__pickStoryRecipe()
+        self.w.after(RELOAD_DELAY, self.__reload)
 
     def splash(self):
         """Welcome user with brief description of program."""
@@ -131,6 +262,7 @@ class Root:
 
     def __pickStoryRecipe(self):
         """Update title label, add buttons for story selection."""
+        self.page = 1
         self.title.config(text = "Select a Story")
 
         # Get iterable object with all story names.
@@ -152,6 +284,8 @@ class Root:
 
         If there is only 1 option, this is skipped.
         """
+        # Now that the story is picked, read the rest of it.
+        self.recipe.load()
         safe = self.recipe.safe_wordlists
 
         # If this recipe has only 1 compatible wordlist, use it.
@@ -160,6 +294,7 @@ class Root:
             self.__playStory()
 
         else:
+            self.page = 2
             self.title.config(text = "Select a Word List")
 
             # Create list of only the compatible wordlists.
@@ -217,19 +352,8 @@ class Root:
         self.prev_id = None
 
         # Add buttons to set the recipe or wordlist.
-        i = 0
         for opt in options:
-            button = tk.Button(
-                self.opt_frame,
-                text = opt,
-                font = TEXT_FONT,
-                bg = BUTTON_BG,
-                fg = BUTTON_FG,
-                command = lambda c = i: choice_func(c)
-            )
-            button.pack(pady = BUTTON_PAD)
-            self.opt_buttons.append(button)
-            i += 1
+            self.__addOption(opt, choice_func)
 
         # Set the function for the Next button.
         self.nav_buttons[-1].configure(
@@ -237,8 +361,28 @@ class Root:
             state = tk.DISABLED
         )
 
+    def __addOption(self, option, choice_func):
+        """Add an option button to the end of the menu.
+
+        Inputs:
+            option = option name for the button
+            choice_func = function to run with the option's number when clicked
+        """
+        i = len(self.opt_buttons)
+        button = tk.Button(
+            self.opt_frame,
+            text = option,
+            font = TEXT_FONT,
+            bg = BUTTON_BG,
+            fg = BUTTON_FG,
+            command = lambda c = i: choice_func(c)
+        )
+        button.pack(pady = BUTTON_PAD)
+        self.opt_buttons.append(button)
+
     def __playStory(self):
         """Play the story, and go back to Page 1."""
+        self.wordlist.load()
         Story(self)
         self.__pickStoryRecipe()
 
@@ -251,6 +395,7 @@ class Story:
         self.root = root
         self.recipe = root.recipe
         self.wordlist = root.wordlist
+        self.buffer = root.getStoryBuffer()
 
         self.title = self.recipe.name
         if self.title != self.wordlist.name:
@@ -263,7 +408,11 @@ class Story:
         self.w.transient(root.w)
         self.w.grab_set()
 
-        self.w.after(1, self.main())
+        # No story text is being added yet.
+        self.insert_job = None
+        self.w.protocol("WM_DELETE_WINDOW", self.__close)
+
+        self.w.after(1, self.main)
         self.w.mainloop()
 
     def main(self):
@@ -309,7 +458,7 @@ class Story:
             font = TEXT_FONT,
             bg = BUTTON_BG,
             fg = BUTTON_FG,
-            command = self.w.destroy
+            command = self.__close
         ).grid(
             row = 0, column = 1,
             padx = BUTTON_PAD, pady = BUTTON_PAD
@@ -332,17 +481,64 @@ class Story:
 
     def __generateStory(self):
         """Generate story for the chosen recipe and wordlist."""
-        story = sc.Story(self.recipe, self.wordlist)
-        story.generate()
+        story = self.buffer.pop(render = False)
+        self.__stopInserting()
 
         # Disable read-only mode on textbox, delete all the text.
         self.story_text["state"] = tk.NORMAL
         self.story_text.delete("1.0", tk.END)
+        self.story_text["state"] = tk.DISABLED
+
+        # A story rendered ahead of time is cut into chunks. One that is not
+        # ready yet is rendered a chunk at a time, as it is shown.
+        if story.story:
+            text = story.story
+            chunks = (
+                text[i:i + TEXT_CHUNK]
+                for i in range(0, len(text), TEXT_CHUNK)
+            )
+        else:
+            chunks = story.iterChunks()
+        self.__insertChunks(chunks)
+
+    def __insertChunks(self, chunks):
+        """Add the next TEXT_CHUNK characters of story, then schedule the rest.
 
-        # Insert the story into textbox, enable read-only mode.
-        self.story_text.insert(tk.INSERT, story.story)
+        Inputs:
+            chunks = iterator of story text strings, in order
+        """
+        # Join small sections up, so each step adds a useful amount of text.
+        text = []
+        size = 0
+        for chunk in chunks:
+            text.append(chunk)
+            size += len(chunk)
+            if size >= TEXT_CHUNK:
+                break
+        if not text:
+            self.insert_job = None
+            return
+
+        # Insert the text into textbox, keeping it read-only in between.
+        self.story_text["state"] = tk.NORMAL
+        self.story_text.insert(tk.END, "".join(text))
         self.story_text["state"] = tk.DISABLED
 
+        self.insert_job = self.w.after(
+            INSERT_DELAY, self.__insertChunks, chunks
+        )
+
+    def __stopInserting(self):
+        """Stop adding the text of the last story, if it is still going."""
+        if self.insert_job != None:
+            self.w.after_cancel(self.insert_job)
+            self.insert_job = None
+
+    def __close(self):
+        """Close this window and return to root one."""
+        self.__stopInserting()
+        self.w.destroy()
+
 
 if __name__ == "__main__":
     Root()
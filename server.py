@@ -0,0 +1,336 @@
+"""HTTP Server Interface for program using asyncio
+
+Endpoints:
+    GET /catalog
+        JSON list of stories, each with its id, name and compatible word lists.
+    GET /generate?story=ID&words=ID&n=COUNT&seed=SEED
+        Generate COUNT stories (default 1) for a story and word list id.
+        The reply streams one JSON string per line, one line per story.
+        Using the same seed gives the same stories again.
+        If the stories stop partway through because of an error, the last
+        line is a JSON object with the error instead of a story.
+
+Connections are kept alive between requests, as usual for HTTP/1.1.
+"""
+
+import story_circus as sc
+import argparse
+import asyncio
+import json
+import random
+from urllib.parse import urlsplit, parse_qs
+
+
+HOST = "127.0.0.1"      # address to listen on by default
+PORT = 8080             # port to listen on by default
+
+MAX_ACTIVE = 8          # most requests generating stories at the same time
+MAX_STORIES = 100000    # most stories a single request can ask for
+CHUNK_STORIES = 100     # stories rendered between each write to the client
+MAX_LINE = 8192         # longest request line or header line accepted
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class HTTPError(Exception):
+    """Error to send back to the client, with its HTTP status code."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Server:
+    """Story generation server, sharing one loaded corpus between requests.
+
+    Public instance variables:
+        corpus = story_circus.Corpus with all of the recipes and wordlists
+        active = asyncio.Semaphore limiting how many requests generate at once
+    """
+
+    def __init__(self, corpus, max_active=MAX_ACTIVE):
+        self.corpus = corpus
+        self.active = asyncio.Semaphore(max_active)
+
+    async def serve(self, host=HOST, port=PORT):
+        """Listen for clients until the program is stopped."""
+        server = await asyncio.start_server(
+            self.handle, host, port, limit = MAX_LINE
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Answer each request from one client, until it hangs up."""
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await readRequest(reader)
+                except ValueError as error:
+                    # The rest of what the client sent can't be trusted, so
+                    # answer once and hang up.
+                    body = json.dumps({"error": str(error)}) + "\n"
+                    await sendResponse(
+                        writer, 400, "application/json", body.encode(), False
+                    )
+                    break
+                if request is None:
+                    break
+                method, target, version, keep_alive = request
+
+                # Only HTTP/1.1 clients understand chunked replies. Older ones
+                # get the plain stories, ended by closing the connection.
+                chunked = version != "HTTP/1.0"
+                if not chunked and target.startswith("/generate"):
+                    keep_alive = False
+
+                try:
+                    await self.__respond(
+                        writer, method, target, chunked, keep_alive
+                    )
+                except HTTPError as error:
+                    body = json.dumps({"error": str(error)}) + "\n"
+                    await sendResponse(
+                        writer, error.status, "application/json",
+                        body.encode(), keep_alive
+                    )
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # The client hung up or sent something that is not HTTP.
+            pass
+        finally:
+            writer.close()
+
+    async def __respond(self, writer, method, target, chunked, keep_alive):
+        """Send the response for a single request."""
+        if method != "GET":
+            raise HTTPError(405, "Only GET is supported.")
+
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+
+        if url.path == "/catalog":
+            body = json.dumps(self.catalog()) + "\n"
+            await sendResponse(
+                writer, 200, "application/json", body.encode(), keep_alive
+            )
+        elif url.path == "/generate":
+            await self.__generate(writer, params, chunked, keep_alive)
+        else:
+            raise HTTPError(404, "There is nothing at " + url.path)
+
+    def catalog(self):
+        """List every story with its compatible word lists."""
+        stories = []
+        for i in range(len(self.corpus.recipes)):
+            recipe = self.corpus.recipes[i]
+            wordlists = []
+            for id in recipe.safe_wordlists:
+                wordlists.append({
+                    "id": id,
+                    "name": self.corpus.wordlists[id].name,
+                })
+            stories.append({
+                "id": i,
+                "name": recipe.name,
+                "wordlists": wordlists,
+            })
+        return {"stories": stories}
+
+    async def __generate(self, writer, params, chunked, keep_alive):
+        """Stream the requested number of stories, one JSON line each."""
+        recipe_id = getNumber(params, "story", None, len(self.corpus.recipes))
+        recipe = self.corpus.recipes[recipe_id]
+        wordlist_id = getNumber(
+            params, "words", None, len(self.corpus.wordlists)
+        )
+        if wordlist_id not in recipe.safe_wordlists:
+            raise HTTPError(404, "That word list does not fit that story.")
+        wordlist = self.corpus.wordlists[wordlist_id]
+        n = getNumber(params, "n", 1, MAX_STORIES + 1, 400)
+        seed = getNumber(params, "seed", random.randrange(2 ** 64))
+
+        # Rendering runs in the default executor, so the event loop is free
+        # to answer other clients while a chunk is being rendered.
+        loop = asyncio.get_running_loop()
+        async with self.active:
+            plan = await loop.run_in_executor(None, recipe.compile, wordlist)
+            rng = random.Random(seed)
+
+            headers = [("X-Story-Seed", str(seed))]
+            if chunked:
+                headers.append(("Transfer-Encoding", "chunked"))
+            await sendHead(
+                writer, 200, "application/x-ndjson", keep_alive, headers
+            )
+            for start in range(0, n, CHUNK_STORIES):
+                count = min(CHUNK_STORIES, n - start)
+                try:
+                    data = await loop.run_in_executor(
+                        None, renderLines, plan, rng, count
+                    )
+                except ValueError as error:
+                    # The status was already sent, so the error is sent as
+                    # the last line, and the reply is still ended properly.
+                    body = json.dumps({"error": str(error)}) + "\n"
+                    await sendChunk(writer, body.encode(), chunked)
+                    break
+                await sendChunk(writer, data, chunked)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+
+
+def renderLines(plan, rng, count):
+    """Render count stories from a RenderPlan, as JSON lines in bytes."""
+    lines = []
+    for i in range(count):
+        lines.append(json.dumps(plan.render(rng)) + "\n")
+    return "".join(lines).encode()
+
+
+async def readRequest(reader):
+    """Read a request's method, target, version, and whether to keep alive.
+
+    Returns a (method, target, version, keep_alive) tuple, or None if the
+    client hung up before sending anything. Any request body is thrown away.
+    Raises ValueError if the request is not HTTP, or a line is too long.
+    """
+    line = await readLine(reader)
+    if not line:
+        return None
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise ValueError("Bad request line")
+    method, target, version = parts
+
+    headers = {}
+    while True:
+        line = await readLine(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = headers.get("content-length", "0")
+    if not length.isdecimal():
+        raise ValueError("Bad Content-Length header")
+    length = int(length)
+    if length:
+        await reader.readexactly(length)
+
+    # HTTP/1.1 keeps the connection open unless told not to; 1.0 is the other
+    # way around.
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+
+    return (method, target, version, keep_alive)
+
+
+async def readLine(reader):
+    """Read one line of a request, raising ValueError if it is too long."""
+    try:
+        return await reader.readline()
+    except ValueError:
+        raise ValueError("Line is longer than %i bytes" % MAX_LINE) from None
+
+
+async def sendHead(writer, status, content_type, keep_alive, headers=()):
+    """Send the status line and headers of a response."""
+    lines = ["HTTP/1.1 %i %s" % (status, REASONS[status])]
+    lines.append("Content-Type: " + content_type)
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    for name, value in headers:
+        lines.append(name + ": " + value)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+
+async def sendResponse(writer, status, content_type, body, keep_alive):
+    """Send a whole response, with a body of bytes."""
+    await sendHead(writer, status, content_type, keep_alive, [
+        ("Content-Length", str(len(body))),
+    ])
+    writer.write(body)
+    await writer.drain()
+
+
+async def sendChunk(writer, data, chunked):
+    """Send part of a streamed body, framed as a chunk if chunked."""
+    if chunked:
+        data = b"%x\r\n%s\r\n" % (len(data), data)
+    writer.write(data)
+    await writer.drain()
+
+
+def getNumber(params, name, default, limit=None, status=404):
+    """Get a whole number from the query parameters.
+
+    Inputs:
+        params = query parameters, as from urllib.parse.parse_qs
+        name = name of the parameter
+        default = value if the parameter is missing, None if it is required
+        limit = number the value must be below, or None for no limit
+        status = HTTP status if the value is not below limit
+            - 404 suits ids of things that do not exist, 400 anything else.
+    """
+    if name not in params:
+        if default is None:
+            raise HTTPError(400, "Missing parameter: " + name)
+        return default
+
+    # isdigit() would also pass digits like "²", which int() can't read.
+    text = params[name][0]
+    if not text.isdecimal():
+        raise HTTPError(400, "Parameter must be a whole number: " + name)
+    number = int(text)
+    if limit is not None and number >= limit:
+        raise HTTPError(status, "Parameter is out of range: " + name)
+    return number
+
+
+def main():
+    """Load the stories, and serve them until the program is stopped."""
+    parser = argparse.ArgumentParser(description = "Story Circus server")
+    parser.add_argument(
+        "--host", default = HOST,
+        help = "address to listen on, default is " + HOST
+    )
+    parser.add_argument(
+        "--port", type = int, default = PORT,
+        help = "port to listen on, default is %i" % PORT
+    )
+    parser.add_argument(
+        "--bundle", metavar = "FILE",
+        help = "read the stories from a bundle FILE instead of data/"
+    )
+    parser.add_argument(
+        "--max-active", type = int, default = MAX_ACTIVE, metavar = "COUNT",
+        help = "most requests generating stories at the same time"
+    )
+    args = parser.parse_args()
+
+    corpus = sc.Corpus(bundle = args.bundle)
+    print("Serving %i stories on http://%s:%i/" % (
+        len(corpus.recipes), args.host, args.port
+    ))
+
+    async def run():
+        await Server(corpus, args.max_active).serve(args.host, args.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,29 @@ The story blueprints and random word lists are loaded from files.
 Users can select the story and word list they would like to generate.
 """
 
+import array
+import collections
+import hashlib
+import io
+import itertools
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
 import random
+import struct
+import sys
+import threading
+import time
+import warnings
+import zlib
+
+# NumPy is optional. It is only used to speed up generating big batches.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = "v2.0"
 __author__ = "Jeremiah Knol"
@@ -23,22 +44,65 @@ __author__ = "Jeremiah Knol"
 STORY_DIR = "data/"
 WORDS_DIR = "data/"
 
+# File to save parsed data files in, for faster loading next time.
+CACHE_FILE = "data/.corpus.cache"
+CACHE_VERSION = 11  # Change this whenever the parsed classes change.
+
+# Word lists at least this many bytes are memory-mapped instead of read in.
+MAP_BYTES = 64 * 1024 * 1024
+
+# Layout of a bundle file's header: magic bytes, format version, and the
+# offset of its index. Each index entry is a name length, offset, size and
+# CRC-32, followed by the name itself.
+BUNDLE_MAGIC = b"SCBUNDLE"
+BUNDLE_VERSION = 1
+BUNDLE_HEADER = struct.Struct(">8sIQ")
+BUNDLE_ENTRY = struct.Struct(">HQQI")
+
+# Defaults for StoryBuffer: how many stories to keep ready, and how many
+# seconds without a story being taken before it stops rendering more.
+BUFFER_DEPTH = 8
+BUFFER_IDLE = 60
+
+# Layout of a story ID: recipe id, wordlist id, corpus version, and seed.
+STORY_ID = struct.Struct(">HHIQ")
+
+# Rounds of the Feistel network used by RankPermutation.
+FEISTEL_ROUNDS = 4
+
+# Stats object collecting timings, or None if they are not being collected.
+_stats = None
+
 
 class StoryRecipe:
     """Story blueprint.
 
     Public instance variables:
         name = title of story, shown in menu
+        filename = path of the .story file the recipe was read from
+            - For a recipe read from a bundle, this is its name in the bundle.
+        bundle = Bundle the recipe was read from, or None for a loose file
         labels = dictionary of labels in this story
             - key = label
             - value = list of sublabels for label
         recipe = list of story sections, in order
             - Items of type "str" are displayed as-is.
             - Items of type "RecipeLabel" are displayed as a random choice.
+            - If the recipe was read lazily, it is split on first use.
+        loaded = True once the recipe has been split
         safe_wordlists = list of wordlist IDs which are compatible
+        safe_mask = the same wordlist IDs, as bits set in an int
+        plans = dictionary of compiled RenderPlan objects
+            - key = WordList object the plan is bound to
+            - value = RenderPlan for this recipe and that wordlist
     """
 
-    def __init__(self, filename):
+    __slots__ = (
+        "name", "filename", "bundle", "labels", "__recipe", "safe_mask",
+        "plans"
+    )
+
+    def __init__(self, filename, lazy=False, bundle=None):
         """Read story data from file. Format and store it.
 
         The first line of the file is the title of the story.
@@ -49,75 +113,286 @@ class StoryRecipe:
 
         Each label creates a key in self.labels.
         Each sublabel is added to that label's list of sublabels.
+
+        If lazy is True, only the name and labels are read for now, which is
+        all the menus and compatibility checks need. The story is split when
+        self.recipe is first used, or when load() is called.
+
+        If a Bundle is given, filename is the name of the file in it.
         """
         self.name = ""
+        self.filename = filename
+        self.bundle = bundle
         self.labels = {}
-        self.recipe = []
-        self.safe_wordlists = []
+        self.__recipe = None
+        self.safe_mask = 0
+        self.plans = {}
 
-        with open(filename, 'r') as file:
-            self.name = file.readline().strip()
-            story = file.read().strip()
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
 
-        self.__splitRecipe(story)
-
-    def __splitRecipe(self, story):
-        start = 0   # The position we are looking at within the story.
-        while True:
-            label_begin = story.find('{', start)
-
-            # If there are no more labels, the rest is plaintext. Add to story.
-            if label_begin == -1:
-                self.recipe.append(story[start:])
-                break
-
-            # If this is not a label, get the plaintext before the label.
-            if label_begin != start:
-                self.recipe.append(story[start:label_begin])
-                start = label_begin
-                continue
-
-            # Otherwise, we know that this is a label.
-            label_end = story.find('}', label_begin + 1)
-            full_label = story[label_begin:label_end + 1]
-
-            # Add the label to the story recipe.
-            label = RecipeLabel(full_label)
-            self.recipe.append(label)
-
-            # Save label and sublabel so we can check wordlist compatibility.
-            lab = label.label
-            sub = label.sublabel
-            if lab not in self.labels.keys():
-                self.labels[lab] = []
-            if sub and sub not in self.labels[lab]:
-                self.labels[lab].append(sub)
-
-            start = label_end + 1
-
-    def checkWordListCompatibility(self, wordlists):
+        with _openDataFile(filename, bundle) as file:
+            self.name = file.readline().strip()
+            story = file.read()
+        self.__readStory(story, lazy)
+
+        if stats is not None:
+            stats.add("load", filename, time.perf_counter() - start)
+
+    @property
+    def recipe(self):
+        if self.__recipe is None:
+            self.load()
+        return self.__recipe
+
+    @property
+    def loaded(self):
+        return self.__recipe is not None
+
+    @property
+    def safe_wordlists(self):
+        return maskIndexes(self.safe_mask)
+
+    @safe_wordlists.setter
+    def safe_wordlists(self, ids):
+        self.safe_mask = 0
+        for i in ids:
+            self.safe_mask |= 1 << i
+
+    def load(self):
+        """Split the story into its recipe, if it was read lazily."""
+        if self.__recipe is not None:
+            return
+
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        with _openDataFile(self.filename, self.bundle) as file:
+            file.readline()
+            story = file.read()
+        self.__readStory(story, False)
+
+        if stats is not None:
+            stats.add("load", self.filename, time.perf_counter() - start)
+
+    def __readStory(self, story, labels_only):
+        recipe, labels = _tokenizeStory(story, self.filename, labels_only)
+
+        # Save labels and sublabels so we can check wordlist compatibility.
+        # Each different label is only looked at once.
+        for label in labels.values():
+            self.__addLabel(label)
+        if not labels_only:
+            self.__recipe = recipe
+
+    def __addLabel(self, label):
+        lab = label.label
+        sub = label.sublabel
+        if lab not in self.labels.keys():
+            self.labels[lab] = []
+        if sub and sub not in self.labels[lab]:
+            self.labels[lab].append(sub)
+
+    def compile(self, wordlist):
+        """Get the RenderPlan binding this recipe to a wordlist.
+
+        The plan is built the first time a wordlist is used with this recipe,
+        and is remembered so later renders can skip all of the parsing work.
+        """
+        plan = self.plans.get(wordlist)
+        if plan is None:
+            stats = _stats
+            if stats is not None:
+                start = time.perf_counter()
+
+            # If two threads race to build it, they both get the first one.
+            plan = self.plans.setdefault(wordlist, RenderPlan(self, wordlist))
+
+            if stats is not None:
+                stats.add("compile", plan.name, time.perf_counter() - start)
+        return plan
+
+    def __getstate__(self):
+        # Plans are left out when pickling. They are rebuilt when needed.
+        return (self.name, self.filename, self.bundle, self.labels,
+                self.__recipe, self.safe_mask)
+
+    def __setstate__(self, state):
+        (self.name, self.filename, self.bundle, self.labels, self.__recipe,
+         self.safe_mask) = state
+        self.plans = {}
+
+    def checkWordListCompatibility(self, wordlists, index=None):
         """Find compatible wordlists for this recipe; mark them by index.
 
         A wordlist is considered compatible if it declares each label used in
         the story, and if each label also has each sublabel used in the story.
-        """
-        self.safe_wordlists = []
 
-        # Use i to loop so we keep track of the index of the wordlist.
-        for i in range(len(wordlists)):
-            if self.__labelsAreCompatible(wordlists[i]):
-                self.safe_wordlists.append(i)
+        If a LabelIndex for wordlists is given, it is used instead of building
+        a new one. Share one index when checking many recipes.
+        """
+        if index is None:
+            index = LabelIndex(wordlists)
+        self.safe_mask = index.compatibleMask(self)
 
-    def __labelsAreCompatible(self, wordlist):
+    def isCompatible(self, wordlist):
+        """Check if a single wordlist is compatible with this recipe."""
         for label in self.labels:
             if label not in wordlist.labels.keys():
                 return False
             for sublabel in self.labels[label]:
-                if sublabel not in wordlist.words[label].labels:
+                if sublabel != label and \
+                        sublabel not in wordlist.labels[label]:
                     return False
         return True
 
 
+class LabelIndex:
+    """Which wordlists declare each label and sublabel, as bit masks.
+
+    Public instance variables:
+        size = number of wordlists indexed
+        masks = dictionary of wordlists declaring a label or sublabel
+            - key = (label, None) for a label, (label, sublabel) for sublabel
+            - value = int with bit i set if wordlist i declares it
+
+    A recipe's compatible wordlists are found by ANDing the masks of every
+    label and sublabel it uses, so no wordlist is ever looked at one by one.
+    """
+
+    __slots__ = ("size", "masks")
+
+    def __init__(self, wordlists):
+        self.size = len(wordlists)
+        self.masks = {}
+
+        for i in range(len(wordlists)):
+            bit = 1 << i
+            for label, sublabels in wordlists[i].labels.items():
+                # The label also counts as one of its own sublabels.
+                for sublabel in [None, label] + sublabels:
+                    key = (label, sublabel)
+                    self.masks[key] = self.masks.get(key, 0) | bit
+
+    def compatibleMask(self, recipe):
+        """Get the wordlists compatible with a recipe, as an int mask."""
+        mask = (1 << self.size) - 1
+        for label, sublabels in recipe.labels.items():
+            mask &= self.masks.get((label, None), 0)
+            for sublabel in sublabels:
+                if not mask:
+                    return 0
+                mask &= self.masks.get((label, sublabel), 0)
+        return mask
+
+
+class StoryFormatError(ValueError):
+    """Mistake in a .story file, with where it was found.
+
+    Public instance variables:
+        filename = path of the file
+        line = line number of the mistake, starting at 1
+        column = column number of the mistake, starting at 1
+    """
+
+    def __init__(self, message, filename, line, column):
+        super().__init__(
+            "%s, line %i, column %i: %s" % (filename, line, column, message)
+        )
+        self.filename = filename
+        self.line = line
+        self.column = column
+
+
+def _tokenizeStory(story, filename, labels_only=False):
+    """Split a story into plaintext and RecipeLabel objects, in one pass.
+
+    Inputs:
+        story = text of a .story file, after its title line
+        filename = path of the file, for error messages
+        labels_only = True to only find the labels, and return no sections
+
+    Returns the list of story sections, or None if labels_only, and a
+    dictionary of every different label by its full text. Each different
+    label is made once, and shared by every section that uses it.
+    Whitespace around the story is left out.
+
+    Raises StoryFormatError if a label is never closed, or has no name.
+    The whole story is still checked if labels_only is True.
+    """
+    sections = None if labels_only else []
+    labels = {}
+    position = len(story) - len(story.lstrip())
+    end = len(story.rstrip())
+    while position < end:
+        begin = story.find('{', position, end)
+
+        # If there are no more labels, the rest is plaintext.
+        if begin == -1:
+            if sections is not None:
+                sections.append(story[position:end])
+            break
+        if begin != position and sections is not None:
+            sections.append(story[position:begin])
+
+        # The label must close before the story ends or another one begins.
+        close = story.find('}', begin + 1, end)
+        if close == -1 or story.find('{', begin + 1, close) != -1:
+            raise _storyError("Label is never closed", story, begin, filename)
+
+        full_label = story[begin:close + 1]
+        label = labels.get(full_label)
+        if label is None:
+            label = _parseLabel(story, begin + 1, close)
+            if not label.label:
+                raise _storyError("Label has no name", story, begin, filename)
+            labels[full_label] = label
+        if sections is not None:
+            sections.append(label)
+
+        position = close + 1
+
+    return sections, labels
+
+
+def _parseLabel(story, begin, end):
+    """Make a RecipeLabel from the label content between begin and end.
+
+    The label comes before the first ':'. The id comes after it, up to a
+    second ':' or the first '/'. The sublabel comes after that '/', up to
+    another '/' or ':'. Anything past a second ':' is ignored.
+    """
+    colon = story.find(':', begin, end)
+    if colon == -1:
+        return RecipeLabel(story[begin:end])
+
+    # Only the part up to a second ':' is used for the id and sublabel.
+    stop = story.find(':', colon + 1, end)
+    if stop == -1:
+        stop = end
+    slash = story.find('/', colon + 1, stop)
+    if slash == -1:
+        return RecipeLabel(story[begin:colon], story[colon + 1:stop])
+
+    sublabel_end = story.find('/', slash + 1, stop)
+    if sublabel_end == -1:
+        sublabel_end = stop
+    return RecipeLabel(
+        story[begin:colon], story[colon + 1:slash],
+        story[slash + 1:sublabel_end]
+    )
+
+
+def _storyError(message, story, position, filename):
+    """Make a StoryFormatError for a position in a story."""
+    # The story starts on line 2, after the title.
+    line = story.count('\n', 0, position) + 2
+    column = position - story.rfind('\n', 0, position)
+    return StoryFormatError(message, filename, line, column)
+
+
 class RecipeLabel:
     """Label section of a StoryRecipe object's recipe list.
 
@@ -130,24 +405,17 @@ class RecipeLabel:
         "{LabelName}"
         "{Person:1}"
         "{Animal:3/Sound}"
-    """
-
-    def __init__(self, content):
-        self.id = None
-        self.sublabel = None
 
-        # Get the label, which comes before ':'.
-        tmp = content[1:-1].split(':')
-        self.label = tmp.pop(0)
+    Labels are split into their parts while the story is tokenized, so a
+    RecipeLabel only stores them.
+    """
 
-        # If there is a suffix, get id, which comes before '/'.
-        if tmp:
-            tmp = tmp[0].split('/')
-            self.id = tmp.pop(0)
+    __slots__ = ("label", "id", "sublabel")
 
-            # If there is a sublabel after '/', get it.
-            if tmp:
-                self.sublabel = tmp[0]
+    def __init__(self, label, id=None, sublabel=None):
+        self.label = label
+        self.id = id
+        self.sublabel = sublabel
 
 
 class WordList:
@@ -155,13 +423,30 @@ class WordList:
 
     Public instance variables:
         name = title of wordlist, shown in menu
+        filename = path of the .words file the wordlist was read from
+            - For a wordlist read from a bundle, this is its name in the bundle.
+        bundle = Bundle the wordlist was read from, or None for a loose file
         labels = dictionary of labels in this wordlist
             - key = label
             - value = list of sublabels for label
         words = dictionary of WordLabel objects from wordlist
+            - If the wordlist was read lazily, it is read on first use.
+        loaded = True once the word options have been read
+        mapped = True if the word options are read from a memory map
+        pool = WordPool the words are shared through, or None, see share()
+
+    A mapped wordlist only indexes where each word option starts in the
+    file, and reads an option when it is picked. This keeps very large
+    wordlists out of memory, and lets processes share them through the
+    operating system's file cache. The file must not be changed in place
+    while it is mapped; replace it with a new file instead.
     """
 
-    def __init__(self, filename):
+    __slots__ = (
+        "name", "filename", "bundle", "labels", "mapped", "pool", "__words"
+    )
+
+    def __init__(self, filename, lazy=False, mapped=None, bundle=None):
         """Read wordlist data from file. Format and store it.
 
         The first line of the file is the title of the wordlist.
@@ -171,16 +456,102 @@ class WordList:
         Each label is followed by a list of word options for that label.
         These lines can be indented however you like.
         Adding a blank line closes the label so you can add another.
+
+        A word option can end with '|' and a whole number weight, such as
+        "fox|3", to make it that many times as likely to be picked.
+
+        If lazy is True, only the name and labels are read for now, which is
+        all the menus and compatibility checks need. The word options are
+        still checked, so a bad file fails now, but they are only kept when
+        self.words is first used, or when load() is called.
+
+        If mapped is None, the file is mapped if it is at least MAP_BYTES.
+        If a Bundle is given, filename is the name of the file in it.
         """
         self.name = None
+        self.filename = filename
+        self.bundle = bundle
         self.labels = {}
-        self.words = {}
+        self.pool = None
+        self.__words = None
+        if mapped is None:
+            if bundle is None:
+                size = os.path.getsize(filename)
+            else:
+                size = bundle.entries[filename][1]
+            mapped = size >= MAP_BYTES
+        self.mapped = mapped
+
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        if mapped and not lazy:
+            self.__mapWords()
+        else:
+            with _openDataFile(filename, bundle) as file:
+                self.name = file.readline().strip()
+                self.__readWords(file, lazy)
+
+        if stats is not None:
+            stats.add("load", filename, time.perf_counter() - start)
+
+    @property
+    def words(self):
+        if self.__words is None:
+            self.load()
+        return self.__words
+
+    @property
+    def loaded(self):
+        return self.__words is not None
+
+    def load(self):
+        """Read the word options, if the wordlist was read lazily."""
+        if self.__words is not None:
+            return
+
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        if self.mapped:
+            self.__mapWords()
+        else:
+            with _openDataFile(self.filename, self.bundle) as file:
+                file.readline()
+                self.__readWords(file, False)
+
+        if stats is not None:
+            stats.add("load", self.filename, time.perf_counter() - start)
+
+    def share(self, pool):
+        """Share this wordlist's words with other wordlists, through a pool.
 
-        with open(filename, 'r') as file:
-            self.name = file.readline().strip()
-            self.__readWords(file)
+        Inputs:
+            pool = WordPool to keep the shared copies of the words in
 
-    def __readWords(self, file):
+        Words already read are swapped for the pool's copies now, and words
+        read lazily are swapped as soon as they are read.
+        """
+        self.pool = pool
+        if self.__words is not None:
+            pool.add(self.__words.values())
+
+    def __getstate__(self):
+        # The pool is left out when pickling. Its words are pickled with the
+        # wordlists that use them, and are still shared within one pickle.
+        return (self.name, self.filename, self.bundle, self.labels,
+                self.mapped, self.__words)
+
+    def __setstate__(self, state):
+        (self.name, self.filename, self.bundle, self.labels, self.mapped,
+         self.__words) = state
+        self.pool = None
+
+    def __readWords(self, file, labels_only):
+        labels = {}
+        words = {}
         label = None
         line = file.readline()
         while line:
@@ -193,14 +564,179 @@ class WordList:
             # If previous line was blank, this one is a label.
             elif label == None:
                 label = line.split('/')
-                self.labels[label[0]] = label[1:]
-                self.words[label[0]] = WordLabel(label)
+                labels[label[0]] = label[1:]
+                if not labels_only:
+                    words[label[0]] = WordLabel(label)
+
+            # Otherwise, this line is a word option for the label. When only
+            # reading labels, it is still checked, so a bad file fails now.
+            elif not labels_only:
+                words[label[0]].addWordOption(line)
+            else:
+                _splitWordOption(line, label)
+
+            line = file.readline()
+
+        # Build the weight tables now, so the first story does not wait.
+        for wordlabel in words.values():
+            wordlabel.weightTable()
+        if self.pool is not None:
+            self.pool.add(words.values())
+
+        self.labels = labels
+        if not labels_only:
+            self.__words = words
+
+    def __mapWords(self):
+        # Same format as __readWords, but only the offset of each word option
+        # is kept. The options are read from the map when they are picked.
+        # A bundle is mapped as a whole, reading only this file's part of it.
+        # Offsets are kept from the start of this file, so they still work
+        # once the bundle is rebuilt with the file somewhere else in it.
+        data = MappedFile(self.filename, self.bundle)
+        lines = data.open()
+        start = data.start()
+        if self.bundle is None:
+            end = len(lines)
+        else:
+            end = start + self.bundle.entries[self.filename][1]
+        lines.seek(start)
+        self.name = lines.readline().decode().strip()
+
+        labels = {}
+        words = {}
+        label = None
+        while lines.tell() < end:
+            offset = lines.tell()
+            line = lines.readline()
+            line = line.strip()
+
+            # If line is blank, the next non-blank line is a label.
+            if not line:
+                label = None
+
+            # If previous line was blank, this one is a label.
+            elif label == None:
+                label = line.decode().split('/')
+                labels[label[0]] = label[1:]
+                offsets = array.array('q')
+                columns = [
+                    MappedColumn(data, offsets, i) for i in range(len(label))
+                ]
+                wordlabel = WordLabel(label, columns)
+                words[label[0]] = wordlabel
 
             # Otherwise, this line is a word option for the label.
             else:
-                self.words[label[0]].addWordOption(line)
+                weight = 1
+                if b'|' in line:
+                    option, weight = _splitWeight(line.decode())
+                    line = option.encode()
+                if line.count(b'/') < len(label) - 1:
+                    raise ValueError(
+                        "Word option %r does not match label %r"
+                        % (line.decode(), '/'.join(label))
+                    )
+                offsets.append(offset - start)
+                wordlabel.addWeight(weight)
+
+        for wordlabel in words.values():
+            wordlabel.weightTable()
+        if self.pool is not None:
+            self.pool.add(words.values())
 
-            line = file.readline()
+        self.labels = labels
+        self.__words = words
+
+
+class MappedFile:
+    """Memory map of a .words file, opened when first used.
+
+    Public instance variables:
+        filename = path of the mapped file
+            - For a file in a bundle, this is its name in the bundle.
+        bundle = Bundle the file is in, or None for a loose file
+
+    Only the filename and bundle are pickled, so each process maps the file
+    itself. A file in a bundle is mapped through the Bundle, so its offsets
+    always come from the same bundle file as the map does.
+    """
+
+    __slots__ = ("filename", "bundle", "__map")
+
+    def __init__(self, filename, bundle=None):
+        self.filename = filename
+        self.bundle = bundle
+        self.__map = None
+
+    def __getstate__(self):
+        return (self.filename, self.bundle)
+
+    def __setstate__(self, state):
+        self.filename, self.bundle = state
+        self.__map = None
+
+    def open(self):
+        """Get the memory map, mapping the file if it is not mapped yet."""
+        if self.__map is None:
+            if self.bundle is not None:
+                self.__map = self.bundle.map()
+            else:
+                with open(self.filename, 'rb') as file:
+                    self.__map = mmap.mmap(
+                        file.fileno(), 0, access = mmap.ACCESS_READ
+                    )
+        return self.__map
+
+    def start(self):
+        """Get the offset in the map where the file starts."""
+        if self.bundle is None:
+            return 0
+        return self.bundle.entries[self.filename][0]
+
+    def line(self, offset):
+        """Get the line starting at offset from the start of the file.
+
+        The line is returned without surrounding whitespace.
+        """
+        data = self.open()
+        offset += self.start()
+        end = data.find(b"\n", offset)
+        if end == -1:
+            end = len(data)
+        return data[offset:end].decode().strip()
+
+
+class MappedColumn:
+    """Column of words read from a MappedFile, one word at a time.
+
+    Public instance variables:
+        data = MappedFile the words are read from
+        offsets = array of the offset of each word option's line
+            - Offsets count from the start of the file, see MappedFile.
+        field = which '/' separated word of the line is in this column
+
+    This can be used anywhere a WordLabel column list is, since it has a
+    length and can be indexed. Nothing is read until a word is indexed.
+    """
+
+    __slots__ = ("data", "offsets", "field")
+
+    def __init__(self, data, offsets, field):
+        self.data = data
+        self.offsets = offsets
+        self.field = field
+
+    def __len__(self):
+        """Get the number of words."""
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        """Read the word at index."""
+        line = self.data.line(self.offsets[index])
+        if '|' in line:
+            line = _splitWeight(line)[0]
+        return line.split('/')[self.field]
 
 
 class WordLabel:
@@ -208,9 +744,20 @@ class WordLabel:
 
     Public instance variables:
         labels = list of labels, first element is main, the rest are sublabels
-        words = list of word options, as dictionaries
-        ids = dictionary of remembered choices popped from pool
-        pool = copy of words to pop choices from
+        columns = list of word columns, one for each label in labels
+            - Each column is a list with one word per word option.
+            - In a mapped wordlist, each column is a MappedColumn instead.
+            - Word option i is made of item i from every column.
+        indexes = dictionary of column indexes
+            - key = label or sublabel
+            - value = index of its column in columns
+        weights = list of each word option's weight, or None if all are 1
+
+    Columns and weights shared through a WordPool are tuples instead of
+    lists. They are copied back into lists before any option is added.
+
+    A WordLabel is never changed while rendering. Anything a story needs to
+    remember is kept by its RenderPlan, so stories can share wordlists.
 
     Examples of valid label content:
         "{LabelName}"
@@ -218,50 +765,820 @@ class WordLabel:
         "{Animal:3/Sound}"
     """
 
-    def __init__(self, labels):
+    __slots__ = ("labels", "columns", "indexes", "weights", "__table")
+
+    def __init__(self, labels, columns=None):
         self.labels = labels
-        self.words = []
-        self.ids = None
-        self.pool = None
+        if columns is None:
+            columns = [[] for label in labels]
+        self.columns = columns
+        self.indexes = {}
+        for i in range(len(labels)):
+            self.indexes.setdefault(labels[i], i)
+        self.weights = None
+        self.__table = None
+
+    def __len__(self):
+        """Get the number of word options."""
+        return len(self.columns[0])
 
     def addWordOption(self, words):
         """Add a word option to the list of words.
 
         Inputs:
             words = words for each sublabel, in order, each separated by '/'
+                - It can end with '|' and a weight, such as "cat/cats|3".
 
-        A dictionary is created with each sublabel as a key, and each word
-        connected to its sublabel. This dictionary is added to the word list.
+        Each word is added to the end of its sublabel's column.
         """
-        opts = words.split('/')
-        options = {}
-        for i in range(len(self.labels)):
-            options[self.labels[i]] = opts[i]
-        self.words.append(options)
+        opts, weight = _splitWordOption(words, self.labels)
 
-    def reset(self):
-        """Clear the remembered words, and reset the pool for them."""
-        self.ids = {}
-        self.pool = self.words.copy()
+        # Copy shared columns before changing them, see share().
+        if type(self.columns[0]) is tuple:
+            self.columns = [list(column) for column in self.columns]
+        for i in range(len(self.columns)):
+            self.columns[i].append(opts[i])
+        self.addWeight(weight)
 
-    def expanded(self, id, sublabel):
-        """Expand this word label, by id and sublabel.
+    def addWeight(self, weight):
+        """Set the weight of the word option that was added last.
 
-        Returns the expanded label as a string.
+        Inputs:
+            weight = how many times as likely the option is as a weight 1 one
 
-        If sublabel is None, the main label will be used.
-        If id is None, any random choice can be chosen.
-        If id doesn't exist, it is created and given a random choice from pool.
-        If id does exist, its random choice is remembered and used again.
+        The list of weights is only made once an option is not weight 1.
         """
+        if self.weights is None:
+            if weight == 1:
+                return
+            self.weights = [1] * (len(self) - 1)
+        elif type(self.weights) is tuple:
+            self.weights = list(self.weights)
+        self.weights.append(weight)
+        self.__table = None
+
+    def share(self, pool):
+        """Swap the words and weights for shared copies kept in a WordPool.
+
+        Mapped columns are left as they are, since they hold no words.
+        """
+        for i in range(len(self.columns)):
+            if type(self.columns[i]) in (list, tuple):
+                self.columns[i] = pool.column(self.columns[i])
+        if self.weights is not None:
+            self.__table = pool.weightTable(self.weights, self.__table)
+            self.weights = self.__table.weights
+
+    def weightTable(self):
+        """Get the WeightTable for the word options, or None if unweighted.
+
+        The table is built the first time it is needed, and kept after that.
+        """
+        if self.__table is None and self.weights is not None:
+            self.__table = WeightTable(self.weights)
+        return self.__table
+
+    def column(self, sublabel):
+        """Get the column of words for a sublabel, or the main label if None."""
         if sublabel == None:
-            sublabel = self.labels[0]
-        if id == None:
-            return random.choice(self.words)[sublabel]
-        if id not in self.ids.keys():
-            x = random.randrange(len(self.pool))
-            self.ids[id] = self.pool.pop(x)
-        return self.ids[id][sublabel]
+            return self.columns[0]
+        return self.columns[self.indexes[sublabel]]
+
+
+class DistinctSampler:
+    """Draws distinct random numbers below size, one at a time.
+
+    Public instance variables:
+        size = how many numbers there are to draw from
+        drawn = how many numbers have been drawn so far
+        swaps = dictionary of numbers moved by the shuffle
+            - key = position in the shuffled numbers
+            - value = number now at that position
+
+    This is a Fisher-Yates shuffle that only shuffles as far as it is drawn.
+    Positions that were never touched hold their own number, so only the
+    moved ones are stored. Each draw takes the same time no matter how big
+    size is, and nothing is copied up front.
+    """
+
+    __slots__ = ("size", "drawn", "swaps")
+
+    def __init__(self, size):
+        self.size = size
+        self.drawn = 0
+        self.swaps = {}
+
+    def draw(self, rng=random):
+        """Draw a number that has not been drawn before, and return it."""
+        if self.drawn >= self.size:
+            raise ValueError("Sample larger than population")
+        return self.drawAt(rng.randrange(self.drawn, self.size))
+
+    def drawAt(self, j):
+        """Draw the number at position j of the shuffle, and return it.
+
+        Position j must be at least self.drawn, since the positions before
+        it are already drawn. draw() picks j at random; picking it some
+        other way gives every order of distinct numbers exactly once.
+        """
+        i = self.drawn
+        if not i <= j < self.size:
+            raise ValueError("Position is already drawn or out of range")
+
+        # Swap position j into position i, and take it.
+        front = self.swaps.pop(i, i)
+        if j == i:
+            number = front
+        else:
+            number = self.swaps.get(j, j)
+            self.swaps[j] = front
+
+        self.drawn = i + 1
+        return number
+
+    def drawMany(self, count, rng=random):
+        """Draw count numbers that have not been drawn before, as a list."""
+        return [self.draw(rng) for i in range(count)]
+
+
+class WeightTable:
+    """Weighted random choice of numbers below size, made ahead of time.
+
+    Public instance variables:
+        size = how many numbers there are to draw from
+        total = sum of all the weights
+        weights = tuple of whole number weights, one per number
+        limits = list of alias table limits, one per number
+        aliases = list of alias table aliases, one per number
+        tree = list of weight sums for WeightedSampler, as a Fenwick tree
+            - tree[i] is the sum of weights[i - (i & -i):i].
+
+    Drawing uses Vose's alias method: pick a number evenly, then keep it or
+    switch to its alias, so each draw takes the same time no matter how big
+    size is. Weights are whole numbers, so the tables are exact.
+    A table is never changed by drawing, so threads can share it freely.
+    """
+
+    __slots__ = ("size", "total", "weights", "limits", "aliases", "tree")
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.total = sum(weights)
+        self.weights = tuple(weights)
+
+        # Scale every weight by size, so an even share is exactly total.
+        # Numbers below their share borrow the rest from one above it.
+        scaled = [weight * self.size for weight in weights]
+        self.limits = [self.total] * self.size
+        self.aliases = list(range(self.size))
+        small = [i for i in range(self.size) if scaled[i] < self.total]
+        large = [i for i in range(self.size) if scaled[i] >= self.total]
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+            self.limits[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= self.total - scaled[less]
+            if scaled[more] < self.total:
+                small.append(large.pop())
+
+        # Fenwick tree of the weights, for drawing without replacement.
+        self.tree = [0] + list(weights)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def draw(self, rng=random):
+        """Draw a number, with the chance of each set by its weight."""
+        i = rng.randrange(self.size)
+        if rng.randrange(self.total) < self.limits[i]:
+            return i
+        return self.aliases[i]
+
+
+class WeightedSampler:
+    """Draws distinct random numbers from a WeightTable, one at a time.
+
+    Public instance variables:
+        table = WeightTable the numbers are drawn from
+        left = sum of the weights of the numbers not drawn yet
+        taken = dictionary of weight taken out of the table's tree
+            - key = index in table.tree
+            - value = weight of drawn numbers taken out of that sum
+
+    Each draw is weighted by the numbers not drawn yet, found by walking
+    down the table's tree. The tree is shared, and only the sums changed by
+    drawing are stored here. Each draw takes time in proportion to the
+    log of size, and nothing is copied up front.
+    """
+
+    __slots__ = ("table", "left", "taken")
+
+    def __init__(self, table):
+        self.table = table
+        self.left = table.total
+        self.taken = {}
+
+    def draw(self, rng=random):
+        """Draw a number that has not been drawn before, and return it."""
+        if self.left <= 0:
+            raise ValueError("Sample larger than population")
+        tree = self.table.tree
+        size = self.table.size
+
+        # Walk down the tree to the number holding this share of the weight.
+        target = rng.randrange(self.left)
+        i = 0
+        step = 1 << (size.bit_length() - 1)
+        while step:
+            child = i + step
+            if child <= size:
+                weight = tree[child] - self.taken.get(child, 0)
+                if target >= weight:
+                    target -= weight
+                    i = child
+            step >>= 1
+
+        # Take its weight out of every sum it is part of.
+        weight = self.table.weights[i]
+        node = i + 1
+        while node <= size:
+            self.taken[node] = self.taken.get(node, 0) + weight
+            node += node & -node
+        self.left -= weight
+        return i
+
+    def drawMany(self, count, rng=random):
+        """Draw count numbers that have not been drawn before, as a list."""
+        return [self.draw(rng) for i in range(count)]
+
+
+class WordPool:
+    """Shared copies of the words of many WordList objects.
+
+    Public instance variables:
+        words = dictionary of every word added, to its shared copy
+        columns = dictionary of every column added, to its shared copy
+            - Shared columns are tuples of shared words.
+        tables = dictionary of every tuple of weights, to its WeightTable
+        saved = bytes of copies thrown out so far, as from sys.getsizeof
+
+    Flavors of a wordlist usually repeat most of each other's words, and
+    often whole labels. Each word, column and weight table is kept once,
+    no matter how many wordlists use it. See WordList.share.
+    """
+
+    def __init__(self):
+        self.words = {}
+        self.columns = {}
+        self.tables = {}
+        self.saved = 0
+
+    def add(self, wordlabels):
+        """Swap the words of each WordLabel for their shared copies."""
+        for wordlabel in wordlabels:
+            wordlabel.share(self)
+
+    def column(self, column):
+        """Get the shared copy of a column of words."""
+        shared = self.columns.get(tuple(column))
+        if shared is column:
+            return shared
+
+        saved = sys.getsizeof(column)
+        if shared is None:
+            words = []
+            for word in column:
+                copy = self.words.setdefault(word, word)
+                if copy is not word:
+                    saved += sys.getsizeof(word)
+                words.append(copy)
+
+            # A column shared by an old pool is kept as it is, since render
+            # plans may still be using it.
+            if type(column) is tuple and saved == sys.getsizeof(column):
+                shared = column
+            else:
+                shared = tuple(words)
+            self.columns[shared] = shared
+            saved -= sys.getsizeof(shared)
+        else:
+            for word, copy in zip(column, shared):
+                if copy is not word:
+                    saved += sys.getsizeof(word)
+
+        self.saved += saved
+        return shared
+
+    def weightTable(self, weights, table=None):
+        """Get the shared WeightTable for a list of weights.
+
+        Inputs:
+            weights = list of whole number weights, one per word option
+            table = WeightTable already built for them, or None
+        """
+        key = tuple(weights)
+        shared = self.tables.get(key)
+        if shared is None:
+            if table is None:
+                table = WeightTable(key)
+            self.tables[key] = table
+            shared = table
+        elif table is not None and table is not shared:
+            for part in (table.weights, table.limits, table.aliases,
+                         table.tree):
+                self.saved += sys.getsizeof(part)
+
+        if weights is not shared.weights:
+            self.saved += sys.getsizeof(weights)
+        return shared
+
+    def report(self):
+        """Get a summary of what is shared and the bytes saved, as a string."""
+        overhead = sys.getsizeof(self.words) + \
+            sys.getsizeof(self.columns) + sys.getsizeof(self.tables)
+        return (
+            "%i words, %i columns and %i weight tables shared, "
+            "saving %i bytes (%i bytes after the pool's own tables)"
+            % (len(self.words), len(self.columns), len(self.tables),
+               self.saved, self.saved - overhead)
+        )
+
+
+class RenderPlan:
+    """StoryRecipe bound to a WordList, flattened so it renders quickly.
+
+    Public instance variables:
+        name = names of the recipe and wordlist, for showing in stats
+        parts = list of story sections, in order
+            - Plaintext sections are stored as-is, merged where adjacent.
+            - Label sections are left blank, to be filled in by slots.
+        slots = list of (position, column, pick, table) tuples, one per label
+            - position = index in parts to put the chosen word
+            - column = list of words for the label's sublabel
+            - pick = index into the picks of a render, None for any choice
+            - table = WeightTable of the label, or None if it is unweighted
+        slot_labels = list of the label filled in by each slot, for stats
+        groups = list of (size, count, table) tuples, one per label with ids
+            - size = number of word options for the label
+            - count = number of distinct ids used for the label
+            - table = WeightTable of the label, or None if it is unweighted
+        group_words = list of (label, columns, shown) tuples, one per group
+            - label = the label of the group
+            - columns = list of every column the group's ids use
+            - shown = list of which of those columns each id shows, as a
+              tuple of indexes into columns, one tuple per id
+
+    All of the label, id and sublabel lookups are done once, here.
+    Rendering only draws random numbers and joins the finished parts.
+    A plan is never changed by rendering, so threads can share it freely.
+    """
+
+    def __init__(self, recipe, wordlist):
+        self.name = recipe.name + " / " + wordlist.name
+        self.parts = []
+        self.slots = []
+        self.slot_labels = []
+        self.groups = []
+        self.group_words = []
+        self.__distinct = None
+        stats = _stats
+
+        columns = {}    # Column of words for each (label, sublabel) pair.
+        ids = {}        # Sublabels shown by each id of a label, in order.
+        id_columns = {} # Columns used by each label's ids, by sublabel.
+        slots = []      # Slots with their (label, id) pair, or None.
+
+        for section in recipe.recipe:
+            # Plaintext is merged into the previous plaintext, if there is any.
+            if type(section) is str:
+                if self.parts and (not slots or
+                                   slots[-1][0] != len(self.parts) - 1):
+                    self.parts[-1] += section
+                else:
+                    self.parts.append(section)
+                continue
+
+            label = section.label
+            wordlabel = wordlist.words[label]
+            sublabel = section.sublabel
+            if sublabel is None:
+                sublabel = wordlabel.labels[0]
+
+            # Get the words for this sublabel, sharing them between slots.
+            if stats is not None:
+                start = time.perf_counter()
+            if (label, sublabel) not in columns:
+                columns[label, sublabel] = wordlabel.column(sublabel)
+            table = wordlabel.weightTable()
+            if stats is not None:
+                stats.add("bind", label, time.perf_counter() - start)
+
+            # Remember each new id, so it gets its own pick.
+            key = None
+            if section.id is not None:
+                key = (label, section.id)
+                ids.setdefault(label, {}).setdefault(section.id, {})
+                ids[label][section.id][sublabel] = None
+                id_columns.setdefault(label, {})[sublabel] = \
+                    columns[label, sublabel]
+
+            slots.append(
+                (len(self.parts), columns[label, sublabel], key, table)
+            )
+            self.slot_labels.append(label)
+            self.parts.append("")
+
+        # Number the picks, so each label's ids are next to each other.
+        picks = {}
+        for label in ids:
+            wordlabel = wordlist.words[label]
+            self.groups.append(
+                (len(wordlabel), len(ids[label]), wordlabel.weightTable())
+            )
+            sublabels = list(id_columns[label])
+            self.group_words.append((
+                label, list(id_columns[label].values()),
+                [tuple(sublabels.index(sublabel) for sublabel in shown)
+                 for shown in ids[label].values()]
+            ))
+            for id in ids[label]:
+                picks[label, id] = len(picks)
+
+        for position, column, key, table in slots:
+            self.slots.append((position, column, picks.get(key), table))
+
+    def render(self, rng=random):
+        """Render a new random story from this plan. Return it as a string.
+
+        Inputs:
+            rng = random.Random object to draw with, default is the module
+        """
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        picks = _drawPicks(self.groups, rng)
+
+        parts = self.parts.copy()
+        if stats is None:
+            for position, column, pick, table in self.slots:
+                if pick is not None:
+                    parts[position] = column[picks[pick]]
+                elif table is None:
+                    parts[position] = rng.choice(column)
+                else:
+                    parts[position] = column[table.draw(rng)]
+        else:
+            # Time each slot by its label, which is only worth it for stats.
+            times = {}
+            for slot, label in zip(self.slots, self.slot_labels):
+                slot_start = time.perf_counter()
+                parts[slot[0]] = _chooseWord(slot, picks, rng)
+                times.setdefault(label, []).append(
+                    time.perf_counter() - slot_start
+                )
+            for label in times:
+                stats.add("label", label, sum(times[label]), len(times[label]))
+        story = "".join(parts)
+
+        if stats is not None:
+            stats.add("render", self.name, time.perf_counter() - start)
+        return story
+
+    def iterRender(self, rng=random):
+        """Render a new random story from this plan, one section at a time.
+
+        Yields each plaintext section and each chosen word as a string, in
+        order, without ever holding the whole story in memory.
+
+        Inputs:
+            rng = random.Random object to draw with, default is the module
+        """
+        # Ids are still picked up front, since there is only a few of them.
+        picks = _drawPicks(self.groups, rng)
+
+        stats = _stats
+        if stats is not None:
+            yield from self.__iterRenderTimed(picks, rng, stats)
+            return
+
+        slots = iter(self.slots)
+        slot = next(slots, None)
+        for position in range(len(self.parts)):
+            if slot is not None and slot[0] == position:
+                column, pick, table = slot[1], slot[2], slot[3]
+                if pick is not None:
+                    yield column[picks[pick]]
+                elif table is None:
+                    yield rng.choice(column)
+                else:
+                    yield column[table.draw(rng)]
+                slot = next(slots, None)
+            elif self.parts[position]:
+                yield self.parts[position]
+
+    def __iterRenderTimed(self, picks, rng, stats):
+        # Same as iterRender, but times each slot by its label. The time is
+        # added as each word is chosen, so it counts even if not finished.
+        slots = iter(zip(self.slots, self.slot_labels))
+        slot, label = next(slots, (None, None))
+        for position in range(len(self.parts)):
+            if slot is not None and slot[0] == position:
+                start = time.perf_counter()
+                word = _chooseWord(slot, picks, rng)
+                stats.add("label", label, time.perf_counter() - start)
+                yield word
+                slot, label = next(slots, (None, None))
+            elif self.parts[position]:
+                yield self.parts[position]
+
+    def renderBatch(self, n, seed=None):
+        """Render n new random stories from this plan. Return them as a list.
+
+        With NumPy, the random choices for every story are drawn at once as
+        arrays, one array per slot, and the stories are joined in one pass.
+        Without NumPy, the stories are rendered one by one from a seeded
+        random.Random object. The same seed gives the same batch each time,
+        but the two ways of drawing do not give the same stories.
+        """
+        if numpy is None:
+            rng = random.Random(seed)
+            return [self.render(rng) for i in range(n)]
+
+        # An empty story has no parts to zip, but is still n empty stories.
+        if not self.parts:
+            return [""] * n
+
+        rng = numpy.random.default_rng(seed)
+
+        picks = []
+        for size, count, table in self.groups:
+            if table is None:
+                picks += _sampleDistinctArrays(rng, size, count, n)
+            else:
+                picks += _sampleWeightedArrays(rng, table, count, n)
+
+        # Put an iterable for every part of the story in order, then zip them.
+        parts = [itertools.repeat(part, n) for part in self.parts]
+        arrays = {}
+        for position, column, pick, table in self.slots:
+            if pick is not None:
+                rows = picks[pick]
+            elif table is None:
+                rows = rng.integers(0, len(column), size=n)
+            else:
+                rows = _sampleWeightedArray(rng, table, n)
+
+            # Mapped columns are only read at the rows that were picked.
+            if isinstance(column, MappedColumn):
+                parts[position] = [column[row] for row in rows.tolist()]
+                continue
+
+            if id(column) not in arrays:
+                arrays[id(column)] = numpy.array(column, dtype=object)
+            parts[position] = arrays[id(column)][rows].tolist()
+        return ["".join(story) for story in zip(*parts)]
+
+    def storyCount(self):
+        """Get the number of different stories this plan can render.
+
+        Each label without an id can be any of its different words. The ids
+        of a label get different rows of words, in order, and sublabels with
+        the same id share that row. Weights change how likely a story is, but
+        not which stories can be made. See distinctOptions.
+
+        Stories where two ids happen to get the same words are not counted.
+        Raises ValueError if the stories can't be counted, see
+        distinctOptions.
+        """
+        groups, slots = self.distinctOptions()
+        count = 1
+        for rows, (size, ids, table) in zip(groups, self.groups):
+            count *= math.perm(len(rows), ids)
+        for words in slots:
+            if words is not None:
+                count *= len(words)
+        return count
+
+    def distinctOptions(self):
+        """Get the word options that give different text, for unique stories.
+
+        Returns a (groups, slots) tuple:
+            groups = list of option indexes for each group in self.groups
+                - There is one index for each different row of words in the
+                  columns the group's ids use, the first option with them.
+            slots = list of different words for each slot in self.slots
+                - Slots with an id get None, since their group is used.
+
+        This reads every word the plan uses, so it is only worked out the
+        first time it is needed, and then remembered. Rendering never uses
+        it, so random stories still pick from every option.
+
+        Two different rows always give a different story, as long as each id
+        shows enough of a row to tell it apart. If ids of a label show
+        different sublabels, two rows may look the same to one of the ids,
+        and the stories can't be counted without repeats. Raises ValueError
+        in that case.
+        """
+        if self.__distinct is None:
+            groups = []
+            for label, columns, shown in self.group_words:
+                rows = {}
+                for i in range(len(columns[0])):
+                    rows.setdefault(tuple(column[i] for column in columns), i)
+
+                # Each id must see every row as different, or two ranks
+                # could give the same story.
+                for fields in set(shown):
+                    seen = set(
+                        tuple(row[field] for field in fields) for row in rows
+                    )
+                    if len(seen) < len(rows):
+                        raise ValueError(
+                            "Ids of label %r show different sublabels, and "
+                            "some word options only differ in a sublabel an "
+                            "id does not show. Unique stories can't be "
+                            "counted for this story and word list." % label
+                        )
+                groups.append(list(rows.values()))
+
+            # Slots sharing a column share its list of different words.
+            slots = []
+            words = {}
+            for position, column, pick, table in self.slots:
+                if pick is not None:
+                    slots.append(None)
+                    continue
+                if id(column) not in words:
+                    words[id(column)] = list(
+                        dict.fromkeys(column[i] for i in range(len(column)))
+                    )
+                slots.append(words[id(column)])
+            self.__distinct = (groups, slots)
+        return self.__distinct
+
+    def unrank(self, rank):
+        """Render the story numbered rank, out of storyCount() stories.
+
+        Every rank gives a story with different words, so walking through
+        different ranks never repeats a story. See iterUnique.
+        """
+        if not 0 <= rank < self.storyCount():
+            raise ValueError("Story rank is out of range")
+        groups, slots = self.distinctOptions()
+
+        # The rank is a mixed radix number, with one digit for each id and
+        # each label without an id. Ids are drawn from a shuffle in order.
+        picks = []
+        for rows, (size, ids, table) in zip(groups, self.groups):
+            sampler = DistinctSampler(len(rows))
+            for i in range(ids):
+                rank, digit = divmod(rank, len(rows) - i)
+                picks.append(rows[sampler.drawAt(i + digit)])
+
+        parts = self.parts.copy()
+        for (position, column, pick, table), words in zip(self.slots, slots):
+            if pick is None:
+                rank, digit = divmod(rank, len(words))
+                parts[position] = words[digit]
+            else:
+                parts[position] = column[picks[pick]]
+        return "".join(parts)
+
+    def iterUnique(self, n=None, seed=None):
+        """Render n different stories, in a random order. Yield each one.
+
+        Inputs:
+            n = number of stories, default is every story this plan can make
+            seed = seed for the order, the same seed gives the same stories
+
+        The stories are unranked from a RankPermutation, so no story is
+        repeated and nothing is kept in memory to check for repeats.
+        Raises ValueError if there are fewer than n different stories.
+        """
+        order = RankPermutation(self.storyCount(), seed)
+        if n is None:
+            n = order.size
+        elif n > order.size:
+            raise ValueError(
+                "There are only %i different stories" % order.size
+            )
+        for i in range(n):
+            yield self.unrank(order[i])
+
+
+class RankPermutation:
+    """Random order of the numbers below size, worked out one at a time.
+
+    Public instance variables:
+        size = how many numbers there are to order
+        seed = seed the order comes from
+        bits = number of bits in each half of the Feistel network
+
+    A Feistel network shuffles every number of 2 * bits bits, with a hash
+    of the seed for its round function. Numbers it shuffles to size or
+    above are shuffled again until they land below size, so the order is
+    still a shuffle of exactly the numbers below size. Looking up any
+    position takes a few hashes, no matter how big size is.
+    """
+
+    def __init__(self, size, seed=None):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.size = size
+        self.seed = seed
+        self.bits = (max(size - 1, 1).bit_length() + 1) // 2
+        self.__key = b"%i:" % seed
+
+    def __getitem__(self, index):
+        """Get the number at a position in the order."""
+        if not 0 <= index < self.size:
+            raise IndexError("Position is out of range")
+        while True:
+            index = self.__shuffle(index)
+            if index < self.size:
+                return index
+
+    def __shuffle(self, number):
+        mask = (1 << self.bits) - 1
+        size = (self.bits + 7) // 8
+        left = number >> self.bits
+        right = number & mask
+        for i in range(FEISTEL_ROUNDS):
+            digest = hashlib.shake_256(
+                self.__key + b"%i:%i" % (i, right)
+            ).digest(size)
+            left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+        return (left << self.bits) | right
+
+
+def _drawPicks(groups, rng):
+    """Draw the distinct ids of every group of a RenderPlan, as one list."""
+    picks = []
+    for size, count, table in groups:
+        if table is None:
+            picks += DistinctSampler(size).drawMany(count, rng)
+        else:
+            picks += WeightedSampler(table).drawMany(count, rng)
+    return picks
+
+
+def _chooseWord(slot, picks, rng):
+    """Choose the word for one slot of a RenderPlan, as render does."""
+    position, column, pick, table = slot
+    if pick is not None:
+        return column[picks[pick]]
+    if table is None:
+        return rng.choice(column)
+    return column[table.draw(rng)]
+
+
+def _sampleWeightedArray(rng, table, n):
+    """Draw n numbers from a WeightTable with NumPy, as one array."""
+    limits = numpy.array(table.limits, dtype=numpy.int64)
+    aliases = numpy.array(table.aliases, dtype=numpy.int64)
+    draw = rng.integers(0, table.size, size=n)
+    keep = rng.integers(0, table.total, size=n) < limits[draw]
+    return numpy.where(keep, draw, aliases[draw])
+
+
+def _sampleWeightedArrays(rng, table, count, n):
+    """Draw count distinct numbers from a WeightTable, n times over.
+
+    Returns a list of count arrays, each holding one draw for all n rows.
+    Each row is drawn with its own WeightedSampler, from a random.Random
+    seeded by rng, since the draws in a row depend on each other.
+    """
+    python_rng = random.Random(int(rng.integers(0, 2 ** 63)))
+    rows = [
+        WeightedSampler(table).drawMany(count, python_rng) for i in range(n)
+    ]
+    return list(numpy.array(rows, dtype=numpy.int64).reshape(n, count).T)
+
+
+def _sampleDistinctArrays(rng, size, count, n):
+    """Draw count distinct numbers below size, n times over, with NumPy.
+
+    Returns a list of count arrays, each holding one draw for all n rows.
+
+    Each draw is made from the numbers still left over, and is then shifted
+    up past every smaller number already taken in its row, so rows never
+    repeat a number. This keeps the work proportional to count, not size.
+    """
+    if count > size:
+        raise ValueError("Sample larger than population")
+
+    draws = []
+    taken = numpy.empty((n, 0), dtype=numpy.int64)
+    for i in range(count):
+        draw = rng.integers(0, size - i, size=n)
+        for column in range(i):
+            draw += draw >= taken[:, column]
+        draws.append(draw)
+        taken = numpy.sort(numpy.column_stack((taken, draw)), axis=1)
+    return draws
 
 
 class Story:
@@ -271,52 +1588,1274 @@ class Story:
         story = string to store the textual story in
         recipe = list of plaintext and RecipeLabel objects in display order
         labels = dictionary of WordLabel objects for filling in RecipeLabels
+        plan = RenderPlan binding the recipe to the wordlist
+        seed = 64-bit number that every random choice in the story comes from
+            - None if the story was not made to be repeated.
+        cache = RenderCache to look the story up in first, or None
+            - It is only used for stories with a seed.
+        rng = random.Random object to draw with when there is no seed, or
+            None to use the random module
+
+    The same recipe, wordlist and seed always make the same story, so a
+    story can be kept as its ID instead of its text. See Corpus.storyId.
+    Making a random.Random for the seed takes longer than rendering most
+    stories, so stories without a seed draw from rng instead.
     """
 
-    def __init__(self, recipe, wordlist):
+    def __init__(self, recipe, wordlist, seed=None, cache=None, rng=None):
+        stats = _stats
+        if stats is not None:
+            start = time.perf_counter()
+
         self.story = ""
         self.recipe = recipe.recipe
         self.labels = wordlist.words
+        self.plan = recipe.compile(wordlist)
+        self.seed = seed
+        self.cache = cache
+        self.rng = rng
+        self.__source = (recipe, wordlist)
 
-        # Reset WordLabel objects for this story.
-        for wordlabel in self.labels.keys():
-            self.labels[wordlabel].reset()
+        if stats is not None:
+            stats.add("story", self.plan.name, time.perf_counter() - start)
 
     def generate(self):
         """Generate the story, expanding plaintext and RecipeLabel objects."""
-        for section in self.recipe:
-            if type(section) is str:
-                self.story += section
+        if self.cache is None or self.seed is None:
+            self.story = self.plan.render(self.__random())
+            return
+
+        recipe, wordlist = self.__source
+        story = self.cache.get(recipe, wordlist, self.seed)
+        if story is None:
+            story = self.plan.render(random.Random(self.seed))
+            self.cache.put(recipe, wordlist, self.seed, story)
+        self.story = story
+
+    def iterChunks(self):
+        """Generate the story, yielding each section as soon as it is ready.
+
+        This is meant for streaming long stories to a file, a socket or the
+        screen. The chunks are not saved, so self.story is left unchanged.
+        """
+        return self.plan.iterRender(self.__random())
+
+    def __random(self):
+        """Get the random number generator to render with."""
+        if self.seed is not None:
+            return random.Random(self.seed)
+        if self.rng is not None:
+            return self.rng
+        return random
+
+
+class RenderCache:
+    """Rendered stories kept for reuse, within a limit on memory.
+
+    Public instance variables:
+        max_bytes = most memory the stored stories may take up
+        bytes = memory the stored stories take up now
+        hits = number of stories found in the cache
+        misses = number of stories not found in the cache
+        evictions = number of stories thrown out to make room
+
+    Stories are stored by (recipe, wordlist, seed). When there is no room
+    for a new story, the least recently used ones are thrown out first.
+    A Corpus with this as its render_cache throws out the stories of any
+    recipe or wordlist it reloads. A single cache can be shared by threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__stories = collections.OrderedDict()
+        self.__keys = {}    # Keys stored for each recipe and wordlist.
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """Get the number of stories stored."""
+        return len(self.__stories)
+
+    def get(self, recipe, wordlist, seed):
+        """Get a stored story as a string, or None if it is not stored."""
+        key = (recipe, wordlist, seed)
+        with self.__lock:
+            story = self.__stories.get(key)
+            if story is None:
+                self.misses += 1
             else:
-                label = section.label
-                id = section.id
-                sublabel = section.sublabel
-                self.story += self.labels[label].expanded(id, sublabel)
+                self.hits += 1
+                self.__stories.move_to_end(key)
+            return story
+
+    def put(self, recipe, wordlist, seed, story):
+        """Store a story, throwing out old ones until it fits.
+
+        A story too big for the whole cache is not stored at all.
+        """
+        size = sys.getsizeof(story)
+        if size > self.max_bytes:
+            return
+
+        key = (recipe, wordlist, seed)
+        with self.__lock:
+            if key in self.__stories:
+                return
+            while self.bytes + size > self.max_bytes:
+                self.__remove(next(iter(self.__stories)))
+                self.evictions += 1
+
+            self.__stories[key] = story
+            self.bytes += size
+            self.__keys.setdefault(recipe, set()).add(key)
+            self.__keys.setdefault(wordlist, set()).add(key)
+
+    def invalidate(self, source):
+        """Throw out every story of a recipe or wordlist."""
+        with self.__lock:
+            for key in list(self.__keys.get(source, ())):
+                self.__remove(key)
+
+    def clear(self):
+        """Throw out every story, keeping the counters."""
+        with self.__lock:
+            self.__stories.clear()
+            self.__keys.clear()
+            self.bytes = 0
+
+    def __remove(self, key):
+        story = self.__stories.pop(key)
+        self.bytes -= sys.getsizeof(story)
+        for source in key[:2]:
+            keys = self.__keys[source]
+            keys.discard(key)
+            if not keys:
+                del self.__keys[source]
+
+
+class StoryBuffer:
+    """Stories for one recipe and wordlist, rendered ahead of time.
+
+    Public instance variables:
+        recipe = StoryRecipe the stories are made from
+        wordlist = WordList the stories are made from
+        depth = most stories to keep ready
+        idle_time = seconds without a pop() before it stops rendering more
+
+    A background thread keeps the buffer filled, so pop() usually just takes
+    a finished story. After idle_time seconds without a pop(), the thread
+    waits until the next one instead of rendering. Call close() to stop it.
+    """
+
+    def __init__(self, recipe, wordlist, depth=BUFFER_DEPTH,
+                 idle_time=BUFFER_IDLE):
+        self.recipe = recipe
+        self.wordlist = wordlist
+        self.depth = depth
+        self.idle_time = idle_time
+        self.__stories = collections.deque()
+        self.__changed = threading.Condition()
+        self.__last_pop = time.monotonic()
+        self.__closed = False
+
+        self.__thread = threading.Thread(target = self.__fill, daemon = True)
+        self.__thread.start()
+
+    def __len__(self):
+        """Get the number of stories ready."""
+        return len(self.__stories)
+
+    def pop(self, render=True):
+        """Take a generated Story. If none are ready, render one now.
+
+        Inputs:
+            render = False to skip rendering a story that is not ready yet,
+                so the caller can stream it with Story.iterChunks instead
+        """
+        with self.__changed:
+            self.__last_pop = time.monotonic()
+            story = self.__stories.popleft() if self.__stories else None
+            self.__changed.notify()
+
+        if story is None:
+            story = Story(self.recipe, self.wordlist)
+            if render:
+                story.generate()
+        return story
+
+    def close(self):
+        """Stop the background thread. Stories already ready are kept."""
+        with self.__changed:
+            self.__closed = True
+            self.__changed.notify()
+        self.__thread.join()
+
+    def __fill(self):
+        while True:
+            with self.__changed:
+                # Wait while full or idle, until a pop() or close() happens.
+                while not self.__closed:
+                    idle = time.monotonic() - self.__last_pop
+                    if len(self.__stories) >= self.depth:
+                        self.__changed.wait()
+                    elif idle >= self.idle_time:
+                        self.__changed.wait()
+                    else:
+                        break
+                if self.__closed:
+                    return
+
+            # Render without holding the lock, so pop() never waits on it.
+            story = Story(self.recipe, self.wordlist)
+            story.generate()
+            with self.__changed:
+                self.__stories.append(story)
+
+
+def closeStaleBuffers(buffers, recipes, wordlists):
+    """Close and forget every StoryBuffer for a recipe or wordlist now gone.
+
+    Inputs:
+        buffers = dictionary of StoryBuffer objects
+            - key = (recipe, wordlist) pair the buffer renders
+        recipes = StoryRecipe objects still in use, as in Corpus.recipes
+        wordlists = WordList objects still in use, as in Corpus.wordlists
+
+    Call this after Corpus.refresh reports changes, so the threads and
+    stories of replaced files are let go.
+    """
+    recipes = set(recipes)
+    wordlists = set(wordlists)
+    for recipe, wordlist in list(buffers):
+        if recipe not in recipes or wordlist not in wordlists:
+            buffers.pop((recipe, wordlist)).close()
+
+
+def generateBatch(recipe, wordlist, n, seed=None):
+    """Generate n stories for a recipe and wordlist. Return them as a list.
+
+    The recipe is compiled for the wordlist once, then all of the stories are
+    rendered together. See RenderPlan.renderBatch for how they are drawn.
+    """
+    return recipe.compile(wordlist).renderBatch(n, seed)
+
+
+class BulkGenerator:
+    """Pool of worker processes for generating huge numbers of stories.
+
+    Public instance variables:
+        recipes = list of StoryRecipe objects the workers can use
+        wordlists = list of WordList objects the workers can use
+        chunk_size = number of stories each worker renders per task
+        pool = multiprocessing.Pool running the workers
+
+    The recipes and wordlists are handed to each worker once, when the pool
+    starts. After that, each task only names them by index.
+
+    Every chunk is seeded from the run's seed and the chunk's own number, so
+    the same seed and chunk size give the same stories for any worker count.
+
+    Use it in a "with" statement, or call close() when finished.
+    """
+
+    def __init__(self, recipes, wordlists, workers=None, chunk_size=1000):
+        """Start the worker processes.
+
+        Inputs:
+            recipes = list of StoryRecipe objects, as from loadStoryRecipes
+            wordlists = list of WordList objects, as from loadWordLists
+            workers = number of processes, default is one per CPU core
+            chunk_size = number of stories each worker renders per task
+        """
+        self.recipes = recipes
+        self.wordlists = wordlists
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(
+            workers, _initBulkWorker, (recipes, wordlists, _stats is not None)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes."""
+        self.pool.terminate()
+        self.pool.join()
+
+    def generate(self, recipe_id, wordlist_id, n, seed=None):
+        """Generate n stories, yielding them in order as lists of stories.
+
+        Inputs:
+            recipe_id = index of the recipe in self.recipes
+            wordlist_id = index of the wordlist in self.wordlists
+            n = total number of stories to generate
+            seed = seed for the whole run, default is a random one
+
+        Each yielded list holds up to chunk_size stories.
+        If stats were enabled when the pool started, the workers' stats are
+        added to this process's stats as each chunk arrives.
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 64)
+
+        tasks = []
+        for chunk in range(0, n, self.chunk_size):
+            count = min(self.chunk_size, n - chunk)
+            chunk_seed = _chunkSeed(seed, recipe_id, wordlist_id, chunk)
+            tasks.append((recipe_id, wordlist_id, count, chunk_seed))
+
+        for stories, stats in self.pool.imap(_bulkChunk, tasks):
+            if stats is not None and _stats is not None:
+                _stats.merge(stats)
+            yield stories
 
 
-def loadStoryRecipes():
-    """Load data from all .story files into a list. Return the list."""
+# Recipes and wordlists given to this process, if it is a bulk worker.
+_bulk_recipes = None
+_bulk_wordlists = None
+
+
+def _initBulkWorker(recipes, wordlists, stats):
+    global _bulk_recipes, _bulk_wordlists
+    _bulk_recipes = recipes
+    _bulk_wordlists = wordlists
+    disableStats()
+    if stats:
+        enableStats()
+
+
+def _bulkChunk(task):
+    """Render a chunk of stories. Return them with the stats for the chunk."""
+    recipe_id, wordlist_id, count, seed = task
+    recipe = _bulk_recipes[recipe_id]
+    plan = recipe.compile(_bulk_wordlists[wordlist_id])
+
+    stats = _stats
+    if stats is not None:
+        start = time.perf_counter()
+    stories = plan.renderBatch(count, seed)
+    if stats is not None:
+        stats.add("batch", plan.name, time.perf_counter() - start)
+
+        # Send this chunk's stats, and start over for the next one.
+        disableStats()
+        enableStats()
+    return (stories, stats)
+
+
+def _chunkSeed(seed, recipe_id, wordlist_id, chunk):
+    """Mix the numbers for a chunk into a single 64-bit seed."""
+    text = "%i/%i/%i/%i" % (seed, recipe_id, wordlist_id, chunk)
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+
+
+def loadStoryRecipes(lazy=False, bundle=None):
+    """Load data from all .story files into a list. Return the list.
+
+    If lazy is True, each story is only split once it is used.
+    If a Bundle is given, the files are read from it instead of STORY_DIR.
+    """
     recipes = []
 
-    for file in sorted(os.listdir(STORY_DIR)):
-        if len(file) >= 6 and file[-6:] == ".story":
-            recipes.append(StoryRecipe(STORY_DIR + file))
+    if bundle is None:
+        paths = listDataFiles(STORY_DIR, ".story")
+    else:
+        paths = bundle.names(".story")
+    for path in paths:
+        recipe = _readDataFile(StoryRecipe, path, lazy, bundle)
+        if recipe is not None:
+            recipes.append(recipe)
 
     return recipes
 
 
-def loadWordLists():
-    """Load data from all .words files into a list. Return the list."""
+def loadWordLists(lazy=False, bundle=None, pool=None):
+    """Load data from all .words files into a list. Return the list.
+
+    If lazy is True, the word options are only read once they are used.
+    If a Bundle is given, the files are read from it instead of WORDS_DIR.
+    If a WordPool is given, the wordlists share their words through it.
+    """
     wordlists = []
 
-    for file in sorted(os.listdir(WORDS_DIR)):
-        if len(file) >= 6 and file[-6:] == ".words":
-            wordlists.append(WordList(WORDS_DIR + file))
+    if bundle is None:
+        paths = listDataFiles(WORDS_DIR, ".words")
+    else:
+        paths = bundle.names(".words")
+    for path in paths:
+        wordlist = _readDataFile(WordList, path, lazy, bundle=bundle)
+        if wordlist is None:
+            continue
+        if pool is not None:
+            wordlist.share(pool)
+        wordlists.append(wordlist)
 
     return wordlists
 
 
+def _readDataFile(kind, path, *args, bad=None, **kwargs):
+    """Read a StoryRecipe or WordList from a data file.
+
+    If the file has a mistake in it, a warning is given and None returned,
+    so one bad file never stops the rest from loading. If a bad dictionary
+    is given, the warning is also saved in it, keyed by path.
+    """
+    try:
+        return kind(path, *args, **kwargs)
+    except ValueError as error:
+        if isinstance(error, StoryFormatError):
+            message = "Skipping bad data file: %s" % error
+        else:
+            message = "Skipping bad data file: %s: %s" % (path, error)
+        warnings.warn(message)
+        if bad is not None:
+            bad[path] = message
+        return None
+
+
+def listDataFiles(directory, extension):
+    """Get the paths of all files in directory with extension, sorted."""
+    paths = []
+
+    for file in sorted(os.listdir(directory)):
+        if len(file) > len(extension) and file.endswith(extension):
+            paths.append(directory + file)
+
+    return paths
+
+
 def checkStoryCompatibilities(recipes, wordlists):
     """Check label compatibility between recipes and wordlists."""
+    stats = _stats
+    if stats is not None:
+        start = time.perf_counter()
+
+    index = LabelIndex(wordlists)
     for recipe in recipes:
-        recipe.checkWordListCompatibility(wordlists)
+        recipe.checkWordListCompatibility(wordlists, index)
+
+    if stats is not None:
+        stats.add("compatibility", "all", time.perf_counter() - start)
+
+
+def findCompatibleRecipes(recipes, wordlist_id):
+    """Get the indexes of the recipes which can use a wordlist, by its index.
+
+    This needs the recipes' compatibility to be checked already.
+    """
+    bit = 1 << wordlist_id
+    found = []
+    for i in range(len(recipes)):
+        if recipes[i].safe_mask & bit:
+            found.append(i)
+    return found
+
+
+def maskIndexes(mask):
+    """Get the indexes of the bits set in an int mask, as a sorted list."""
+    indexes = []
+    while mask:
+        low = mask & -mask
+        indexes.append(low.bit_length() - 1)
+        mask ^= low
+    return indexes
+
+
+class Stats:
+    """Time spent and number of calls for each part of the program.
+
+    Public instance variables:
+        times = dictionary of total seconds spent
+            - key = (kind, name) tuple, like ("render", "Silly Farm / Farm 1")
+            - value = total seconds
+        counts = dictionary of number of calls, with the same keys
+
+    Kinds of things timed, and what they are named by:
+        "load" = reading a data file, by path
+        "compatibility" = checking recipes against wordlists, "all" from
+          checkStoryCompatibilities, "corpus" from loading a Corpus
+        "refresh" = checking the corpus for changed files
+        "compile" = building a RenderPlan, by recipe and wordlist names
+        "story" = creating a Story, by recipe and wordlist names
+        "render" = rendering a story from a RenderPlan, by the same names
+        "batch" = rendering a chunk of stories in a bulk worker, the same
+        "bind" = looking up a label's words for a RenderPlan, by label
+        "label" = choosing a word for a label while rendering, by label
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    def add(self, kind, name, seconds, calls=1):
+        """Record calls, one by default, taking some number of seconds."""
+        key = (kind, name)
+        self.times[key] = self.times.get(key, 0.0) + seconds
+        self.counts[key] = self.counts.get(key, 0) + calls
+
+    def merge(self, other):
+        """Add all of the times and calls from another Stats object."""
+        for key in other.times:
+            self.times[key] = self.times.get(key, 0.0) + other.times[key]
+            self.counts[key] = self.counts.get(key, 0) + other.counts[key]
+
+    def report(self):
+        """Get a table of the stats, slowest first, as a string."""
+        lines = ["%-14s %-40s %9s %12s %12s" % (
+            "kind", "name", "calls", "total ms", "mean us"
+        )]
+        keys = sorted(self.times, key = lambda k: self.times[k], reverse = True)
+        for kind, name in keys:
+            seconds = self.times[kind, name]
+            calls = self.counts[kind, name]
+            lines.append("%-14s %-40s %9i %12.3f %12.2f" % (
+                kind, name[-40:], calls, seconds * 1e3, seconds / calls * 1e6
+            ))
+        return "\n".join(lines)
+
+
+def enableStats():
+    """Start collecting timings. Return the Stats object they are added to.
+
+    While stats are disabled, which is the default, each timed spot costs
+    only a check of a global variable.
+    """
+    global _stats
+    if _stats is None:
+        _stats = Stats()
+    return _stats
+
+
+def disableStats():
+    """Stop collecting timings. Return the Stats collected, or None."""
+    global _stats
+    stats = _stats
+    _stats = None
+    return stats
+
+
+def getStats():
+    """Get the Stats object being collected, or None if disabled."""
+    return _stats
+
+
+class Bundle:
+    """Story and word list files packed into one indexed file.
+
+    Public instance variables:
+        filename = path of the bundle file
+        entries = dictionary of the files packed in the bundle
+            - key = name of the file, such as "animal_fun.words"
+            - value = (offset, size, CRC-32 checksum) tuple of its bytes
+        stat = (modified time, size) tuple of the bundle when it was opened
+
+    The bundle is opened once and kept open, and each file is read from it
+    by name when needed. Replacing the bundle file does not change what an
+    open Bundle reads. The file is closed by close(), or once nothing refers
+    to the Bundle any more. Use buildBundle to make one from the data files.
+    """
+
+    def __init__(self, filename):
+        """Open a bundle file and read its index.
+
+        Raises ValueError if the file is not a bundle this version can read.
+        """
+        self.filename = filename
+        self.__lock = threading.Lock()
+        self.__map = None
+        self.__file = open(filename, 'rb')
+        stat = os.fstat(self.__file.fileno())
+        self.stat = (stat.st_mtime_ns, stat.st_size)
+
+        magic, version, index = BUNDLE_HEADER.unpack(
+            self.__file.read(BUNDLE_HEADER.size)
+        )
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            self.__file.close()
+            raise ValueError("Not a story bundle: " + filename)
+
+        # The index runs from its offset to the end of the file.
+        self.__file.seek(index)
+        data = self.__file.read()
+        self.entries = {}
+        position = 0
+        while position < len(data):
+            length, offset, size, crc = BUNDLE_ENTRY.unpack_from(
+                data, position
+            )
+            position += BUNDLE_ENTRY.size
+            name = data[position:position + length].decode()
+            position += length
+            self.entries[name] = (offset, size, crc)
+
+    def __getstate__(self):
+        # Only the filename is pickled, the file is opened again on loading.
+        return self.filename
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def names(self, extension):
+        """Get the names of all files in the bundle with extension, sorted."""
+        return sorted(
+            name for name in self.entries
+            if len(name) > len(extension) and name.endswith(extension)
+        )
+
+    def read(self, name):
+        """Get the bytes of a file in the bundle.
+
+        Raises ValueError if they do not match the checksum in the index.
+        """
+        offset, size, crc = self.entries[name]
+        with self.__lock:
+            self.__file.seek(offset)
+            data = self.__file.read(size)
+        if zlib.crc32(data) != crc:
+            raise ValueError("File is damaged in bundle %s: %s" % (
+                self.filename, name
+            ))
+        return data
+
+    def open(self, name):
+        """Open a file in the bundle as text, the same way open() would."""
+        return io.TextIOWrapper(io.BytesIO(self.read(name)))
+
+    def map(self):
+        """Get a memory map of the whole bundle file, mapping it once.
+
+        The map is made from the open file, so it matches self.entries even
+        if the bundle file has been replaced since.
+        """
+        with self.__lock:
+            if self.__map is None:
+                self.__map = mmap.mmap(
+                    self.__file.fileno(), 0, access = mmap.ACCESS_READ
+                )
+            return self.__map
+
+    def close(self):
+        """Close the bundle file."""
+        self.__file.close()
+
+    def __del__(self):
+        # A bundle that failed to open has no file to close.
+        if hasattr(self, "_Bundle__file"):
+            self.__file.close()
+
+
+def buildBundle(filename):
+    """Pack every .story and .words file into a new bundle file.
+
+    The files are read from STORY_DIR and WORDS_DIR. The bundle is written
+    to a temporary file first and then moved into place, so anything
+    reading the old bundle never sees a half written one.
+
+    Returns the number of files packed.
+    """
+    paths = listDataFiles(STORY_DIR, ".story") + \
+        listDataFiles(WORDS_DIR, ".words")
+
+    index = []
+    with open(filename + ".tmp", 'wb') as file:
+        file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, 0))
+        for path in paths:
+            with open(path, 'rb') as data_file:
+                data = data_file.read()
+            name = os.path.basename(path).encode()
+            index.append(BUNDLE_ENTRY.pack(
+                len(name), file.tell(), len(data), zlib.crc32(data)
+            ) + name)
+
+            # A newline after each file keeps a mapped wordlist's last line
+            # from running into the next file. It is not part of the file.
+            file.write(data + b"\n")
+
+        # Write the index at the end, then point the header at it.
+        offset = file.tell()
+        file.write(b"".join(index))
+        file.seek(0)
+        file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, offset))
+    os.replace(filename + ".tmp", filename)
+
+    return len(paths)
+
+
+def _splitWordOption(option, labels):
+    """Split a word option into its words and its weight.
+
+    Inputs:
+        option = line of a .words file, such as "cat/cats|3"
+        labels = list of the label and sublabels the option is for
+
+    Returns the list of words, and the weight as an int.
+    Raises ValueError if there are fewer words than labels, or the weight
+    is bad, see _splitWeight.
+    """
+    weight = 1
+    if '|' in option:
+        option, weight = _splitWeight(option)
+    words = option.split('/')
+    if len(words) < len(labels):
+        raise ValueError(
+            "Word option %r does not match label %r"
+            % (option, '/'.join(labels))
+        )
+    return words, weight
+
+
+def _splitWeight(option):
+    """Split a word option's weight off of it, as in "fox|3".
+
+    Returns the option without its weight, and the weight as an int.
+    Raises ValueError if the weight is not a whole number above 0.
+    """
+    words, bar, weight = option.rpartition('|')
+    weight = weight.strip()
+    if not weight.isdigit() or int(weight) < 1:
+        raise ValueError("Word option %r has a bad weight" % option)
+    return words.rstrip(), int(weight)
+
+
+def _openDataFile(filename, bundle):
+    """Open a data file as text, from a Bundle if one is given."""
+    if bundle is None:
+        return open(filename, 'r')
+    return bundle.open(filename)
+
+
+class Corpus:
+    """All of the story recipes and wordlists, loaded through a cache file.
+
+    Public instance variables:
+        recipes = list of StoryRecipe objects, sorted by filename
+        wordlists = list of WordList objects, sorted by filename
+        recipe_files = list of .story file paths, in the same order
+        wordlist_files = list of .words file paths, in the same order
+        stats = dictionary of file stats for every loaded file
+            - key = path of the file
+            - value = (modified time, size) tuple
+            - For files in a bundle, it is a (CRC-32, size) tuple instead.
+        hashes = dictionary of CRC-32 checksums of every loaded file's bytes
+        bad_files = dictionary of data files that could not be read
+            - key = path of the file
+            - value = the warning it was skipped with
+            - Their stats are kept too, so they are only read again once
+              they change.
+        version = CRC-32 of every file's name and checksum, see storyId
+        render_cache = RenderCache used by story(), or None to not use one
+            - Stories of reloaded files are thrown out of it by refresh().
+        cache_file = path of the cache file, or None to not use one
+        lazy = True if files are read lazily, see StoryRecipe and WordList
+        bundle = Bundle the files are read from, or None to read loose files
+            - If the bundle file is replaced, refresh() opens the new one.
+        pool = WordPool every wordlist shares its words through
+            - refresh() starts a new one, so removed words are let go.
+
+    The cache file holds every parsed recipe and wordlist, their file stats,
+    the warning for each bad file, and the compatibility between them. When
+    loading, a file is only parsed again if its stats have changed, and
+    compatibility is only checked again if any file was added, removed or
+    changed. A corpus that is not lazy fully reads any file that a lazy
+    corpus cached unread.
+    """
+
+    def __init__(self, cache_file=CACHE_FILE, lazy=False, progress=None,
+                 bundle=None):
+        """Load the corpus, using and then updating the cache file.
+
+        Inputs:
+            cache_file = path of the cache file, or None to not use one
+            lazy = True to read files lazily, see StoryRecipe and WordList
+            progress = function to call after each file is loaded, or None
+                - It is called as progress(done, total, item), where item
+                  is the StoryRecipe or WordList that was just loaded.
+            bundle = path of a bundle file to read instead of loose files
+
+        All of the wordlists are loaded before any recipe, so each recipe
+        passed to progress already has its compatible wordlists set. This
+        lets a menu show the recipes while the rest are still loading.
+        """
+        self.cache_file = cache_file
+        self.lazy = lazy
+        self.render_cache = None
+        self.bundle = None if bundle is None else Bundle(bundle)
+        self.pool = WordPool()
+        self.bundle, self.stats = self.__statFiles(self.bundle)
+
+        cache = self.__readCache()
+        changed = False
+        parsed = False      # Cached files read lazily before, read fully now.
+        self.hashes = {}
+        total = len(self.stats)
+        done = 0
+
+        # Bad files are skipped with a warning, but their stats are kept, so
+        # they are only read again once they change.
+        self.bad_files = {}
+        self.wordlists = []
+        self.wordlist_files = []
+        for path in _pathsWith(self.stats, ".words"):
+            done += 1
+            if self.__knownBad(cache, path):
+                continue
+            wordlist = cache.get(path)
+            if wordlist is None or cache.stats.get(path) != self.stats[path]:
+                changed = True
+                wordlist = _readDataFile(
+                    WordList, path, lazy, bundle=self.bundle,
+                    bad=self.bad_files
+                )
+                if wordlist is None:
+                    continue
+                self.hashes[path] = self.__fileHash(path, self.bundle)
+            else:
+                self.hashes[path] = cache.hashes[path]
+                self.__useBundle(wordlist, self.bundle)
+
+                # A lazy corpus may have cached it unread. Read it now, so
+                # an eager corpus, and anything it is pickled to, has it.
+                if not lazy and not wordlist.loaded:
+                    wordlist.load()
+                    parsed = True
+            wordlist.share(self.pool)
+            self.wordlists.append(wordlist)
+            self.wordlist_files.append(path)
+            if progress is not None:
+                progress(done, total, wordlist)
+
+        # If any wordlist was added, changed or removed, every recipe's
+        # compatibility must be checked again. Otherwise only new recipes.
+        if _pathsWith(self.stats, ".words") != \
+                _pathsWith(cache.stats, ".words"):
+            changed = True
+        index = self.__timeCompatibility(LabelIndex, self.wordlists)
+
+        self.recipes = []
+        self.recipe_files = []
+        for path in _pathsWith(self.stats, ".story"):
+            done += 1
+            if self.__knownBad(cache, path):
+                continue
+            recipe = cache.get(path)
+            if recipe is None or cache.stats.get(path) != self.stats[path]:
+                changed = True
+                recipe = _readDataFile(
+                    StoryRecipe, path, lazy, self.bundle, bad=self.bad_files
+                )
+                if recipe is None:
+                    continue
+                self.hashes[path] = self.__fileHash(path, self.bundle)
+                self.__timeCompatibility(
+                    recipe.checkWordListCompatibility, self.wordlists, index
+                )
+            else:
+                self.hashes[path] = cache.hashes[path]
+                self.__useBundle(recipe, self.bundle)
+                recipe.safe_mask = cache.masks[path]
+                if not lazy and not recipe.loaded:
+                    recipe.load()
+                    parsed = True
+                if changed:
+                    self.__timeCompatibility(
+                        recipe.checkWordListCompatibility, self.wordlists,
+                        index
+                    )
+            self.recipes.append(recipe)
+            self.recipe_files.append(path)
+            if progress is not None:
+                progress(done, total, recipe)
+
+        self.version = _corpusVersion(self.hashes)
+
+        # Removed recipes and fully read files do not change anything else,
+        # but still need saving.
+        if changed or parsed or len(cache.stats) != len(self.stats):
+            self.__writeCache(
+                self, [recipe.safe_mask for recipe in self.recipes]
+            )
+
+    def refresh(self):
+        """Reload every data file that was added, changed or removed.
+
+        Returns a sorted list of the paths that changed, empty if none did.
+
+        Only the changed files are read again. Compatibility is only checked
+        for changed recipes against every wordlist, and for every recipe
+        against changed wordlists. The rest is kept, with the wordlist indexes
+        moved to match the new order.
+
+        The recipes and wordlists lists are updated in place, so anything
+        holding onto them sees the new files. Call this as often as you like
+        to watch for changes, it only looks at the file stats.
+
+        This is prepareRefresh and applyRefresh in one go. To read the files
+        on another thread, call those two instead.
+        """
+        update = self.prepareRefresh()
+        if update is None:
+            return []
+        return self.applyRefresh(update)
+
+    def prepareRefresh(self):
+        """Read every data file that was added, changed or removed.
+
+        Returns a _CorpusUpdate to pass to applyRefresh, or None if nothing
+        changed. The cache file is written for the update here too.
+
+        The corpus is not changed, so this can run on another thread while
+        the recipes and wordlists are in use. Kept recipes and wordlists are
+        only moved to the new bundle and WordPool, which gives them the same
+        words they had.
+        """
+        timing = _stats
+        if timing is not None:
+            start = time.perf_counter()
+
+        bundle, stats = self.__statFiles(self.bundle)
+        changed = set(self.stats.keys() ^ stats.keys())
+        for path in self.stats.keys() & stats.keys():
+            if self.stats[path] != stats[path]:
+                changed.add(path)
+        if not changed:
+            return None
+
+        update = _CorpusUpdate(self.stats, bundle, stats, sorted(changed))
+
+        # Keep the unchanged wordlists, and remember where they moved to.
+        # Unchanged bad files were skipped before, and are skipped again.
+        old_wordlists = {}
+        for i in range(len(self.wordlist_files)):
+            old_wordlists[self.wordlist_files[i]] = (i, self.wordlists[i])
+        wordlists = update.wordlists
+        moved = {}      # New index for each old index that was kept.
+        fresh = []      # New indexes of changed and added wordlists.
+        for path in _pathsWith(stats, ".words"):
+            if path in changed:
+                wordlist = _readDataFile(
+                    WordList, path, self.lazy, bundle=bundle,
+                    bad=update.bad_files
+                )
+                if wordlist is None:
+                    continue
+                fresh.append(len(wordlists))
+                update.hashes[path] = self.__fileHash(path, bundle)
+            elif path in old_wordlists:
+                update.hashes[path] = self.hashes[path]
+                i, wordlist = old_wordlists[path]
+                moved[i] = len(wordlists)
+                self.__useBundle(wordlist, bundle)
+            else:
+                update.bad_files[path] = self.bad_files[path]
+                continue
+            wordlists.append(wordlist)
+            update.wordlist_files.append(path)
+
+        # Share through a new pool, so the words of old files can be freed.
+        # Kept wordlists go first, so their shared columns stay as they are.
+        for i in range(len(wordlists)):
+            if i not in fresh:
+                wordlists[i].share(update.pool)
+        for i in fresh:
+            wordlists[i].share(update.pool)
+
+        # New recipes get their masks now, since nothing is using them yet.
+        # Kept recipes get theirs in applyRefresh.
+        old_recipes = dict(zip(self.recipe_files, self.recipes))
+        index = self.__timeCompatibility(LabelIndex, wordlists)
+        fresh_mask = 0
+        for i in fresh:
+            fresh_mask |= 1 << i
+        for path in _pathsWith(stats, ".story"):
+            if path in changed:
+                recipe = _readDataFile(
+                    StoryRecipe, path, self.lazy, bundle,
+                    bad=update.bad_files
+                )
+                if recipe is None:
+                    continue
+                self.__timeCompatibility(
+                    recipe.checkWordListCompatibility, wordlists, index
+                )
+                mask = recipe.safe_mask
+                update.hashes[path] = self.__fileHash(path, bundle)
+            elif path in old_recipes:
+                recipe = old_recipes[path]
+                update.hashes[path] = self.hashes[path]
+                self.__useBundle(recipe, bundle)
+                mask = 0
+                for i in recipe.safe_wordlists:
+                    if i in moved:
+                        mask |= 1 << moved[i]
+                if fresh_mask:
+                    mask |= fresh_mask & self.__timeCompatibility(
+                        index.compatibleMask, recipe
+                    )
+            else:
+                update.bad_files[path] = self.bad_files[path]
+                continue
+            update.recipes.append(recipe)
+            update.recipe_files.append(path)
+            update.masks.append(mask)
+        self.__writeCache(update, update.masks)
+
+        if timing is not None:
+            timing.add("refresh", "corpus", time.perf_counter() - start)
+        return update
+
+    def applyRefresh(self, update):
+        """Switch the corpus over to the files read by prepareRefresh.
+
+        Returns a sorted list of the paths that changed.
+
+        Call this on the thread that uses the corpus, so nothing sees it
+        half switched. Raises ValueError if the corpus was refreshed after
+        the update was prepared, since its wordlist indexes would be wrong.
+        """
+        if update.old_stats is not self.stats:
+            raise ValueError("The corpus changed since the update was made")
+
+        kept = set(update.wordlists)
+        for recipe, mask in zip(update.recipes, update.masks):
+            recipe.safe_mask = mask
+
+            # Forget plans for wordlists that were replaced or removed.
+            for wordlist in list(recipe.plans):
+                if wordlist not in kept:
+                    del recipe.plans[wordlist]
+
+        # Throw out stories of every recipe and wordlist that was replaced.
+        if self.render_cache is not None:
+            kept.update(update.recipes)
+            for source in self.recipes + self.wordlists:
+                if source not in kept:
+                    self.render_cache.invalidate(source)
+
+        self.bundle = update.bundle
+        self.stats = update.stats
+        self.hashes = update.hashes
+        self.bad_files = update.bad_files
+        self.pool = update.pool
+        self.version = _corpusVersion(update.hashes)
+        self.recipe_files = update.recipe_files
+        self.wordlist_files = update.wordlist_files
+        self.recipes[:] = update.recipes
+        self.wordlists[:] = update.wordlists
+        return update.changed
+
+    def __knownBad(self, cache, path):
+        # A bad file that has not changed is skipped without reading it again,
+        # with the same warning as when it was read.
+        if path not in cache.bad or cache.stats.get(path) != self.stats[path]:
+            return False
+        self.bad_files[path] = cache.bad[path]
+        warnings.warn(cache.bad[path])
+        return True
+
+    def __timeCompatibility(self, check, *args):
+        # Call one part of the compatibility check, timing it if enabled.
+        stats = _stats
+        if stats is None:
+            return check(*args)
+        start = time.perf_counter()
+        result = check(*args)
+        stats.add("compatibility", "corpus", time.perf_counter() - start)
+        return result
+
+    def recipesFor(self, wordlist_id):
+        """Get the indexes of the recipes which can use a wordlist."""
+        return findCompatibleRecipes(self.recipes, wordlist_id)
+
+    def storyId(self, recipe_id, wordlist_id, seed):
+        """Get the 16-byte ID of a story, so it can be made again later.
+
+        Inputs:
+            recipe_id = index of the recipe in self.recipes
+            wordlist_id = index of the wordlist in self.wordlists
+            seed = seed of the story, as in Story.seed
+
+        The ID also holds self.version, so it is only used with exactly the
+        same files it was made from.
+        """
+        return STORY_ID.pack(recipe_id, wordlist_id, self.version, seed)
+
+    def story(self, story_id):
+        """Make the story with the given ID again. Return the Story object.
+
+        Raises ValueError if the ID is from a different version of the
+        corpus, or does not point at a compatible recipe and wordlist.
+        """
+        recipe_id, wordlist_id, version, seed = STORY_ID.unpack(story_id)
+        if version != self.version:
+            raise ValueError("Story ID is from a different corpus version")
+        if recipe_id >= len(self.recipes) or \
+                wordlist_id not in self.recipes[recipe_id].safe_wordlists:
+            raise ValueError("Story ID does not match any story")
+
+        story = Story(
+            self.recipes[recipe_id], self.wordlists[wordlist_id], seed,
+            self.render_cache
+        )
+        story.generate()
+        return story
+
+    def __statFiles(self, bundle):
+        """Get the bundle and the stats of every data file.
+
+        Returns a (bundle, stats) tuple. Without a bundle, it is None, and
+        the stats are from _statDataFiles.
+
+        With a bundle, this only looks at the bundle file's own stats, and
+        opens it again if it was replaced. Each file's stats are then taken
+        from the bundle's index.
+        """
+        if bundle is None:
+            return None, _statDataFiles()
+
+        stat = os.stat(bundle.filename)
+        if (stat.st_mtime_ns, stat.st_size) != bundle.stat:
+            bundle = Bundle(bundle.filename)
+        stats = {}
+        for name, (offset, size, crc) in bundle.entries.items():
+            if name.endswith(".story") or name.endswith(".words"):
+                stats[name] = (crc, size)
+        return bundle, stats
+
+    def __useBundle(self, source, bundle):
+        """Read an unchanged recipe or wordlist from the current bundle.
+
+        Its file is the same in every bundle it was kept through, so this
+        only lets go of the old Bundle, which closes once nothing uses it.
+        """
+        if bundle is not None:
+            source.bundle = bundle
+
+    def __fileHash(self, path, bundle):
+        """Get the CRC-32 checksum of a data file, see _fileHash."""
+        if bundle is None:
+            return _fileHash(path)
+        return bundle.entries[path][2]
+
+    def __readCache(self):
+        """Read the cache file. Return a _CorpusCache, empty if unusable."""
+        if self.cache_file is None:
+            return _CorpusCache()
+        try:
+            with open(self.cache_file, 'rb') as file:
+                cache = pickle.load(file)
+        except Exception:
+            # A missing, old or broken cache is simply built again.
+            return _CorpusCache()
+        if type(cache) is not _CorpusCache or cache.version != CACHE_VERSION:
+            return _CorpusCache()
+        return cache
+
+    def __writeCache(self, source, masks):
+        """Write the cache file, replacing the old one all at once.
+
+        Inputs:
+            source = this Corpus, or a _CorpusUpdate that is not applied yet
+            masks = list of the safe_mask of each recipe in source.recipes
+                - They are kept apart from the recipes, since the recipes of
+                  an update still have their old masks.
+        """
+        if self.cache_file is None:
+            return
+        cache = _CorpusCache()
+        cache.stats = source.stats
+        cache.hashes = source.hashes
+        cache.bad = source.bad_files
+        cache.masks = dict(zip(source.recipe_files, masks))
+        cache.objects = dict(zip(
+            source.recipe_files + source.wordlist_files,
+            source.recipes + source.wordlists
+        ))
+        try:
+            with open(self.cache_file + ".tmp", 'wb') as file:
+                pickle.dump(cache, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except OSError:
+            # The corpus still works without a cache, it just loads slower.
+            pass
+
+
+class _CorpusCache:
+    """Contents of a cache file, see Corpus."""
+
+    def __init__(self):
+        self.version = CACHE_VERSION
+        self.stats = {}
+        self.hashes = {}
+        self.bad = {}
+        self.masks = {}
+        self.objects = {}
+
+    def get(self, path):
+        return self.objects.get(path)
+
+
+class _CorpusUpdate:
+    """Files read by Corpus.prepareRefresh, for Corpus.applyRefresh.
+
+    It has the same variables as the Corpus it replaces, see Corpus, and:
+        old_stats = stats of the corpus it was prepared from
+        changed = sorted list of the paths that changed
+        masks = list of the new safe_mask of each recipe in recipes
+    """
+
+    def __init__(self, old_stats, bundle, stats, changed):
+        self.old_stats = old_stats
+        self.bundle = bundle
+        self.stats = stats
+        self.changed = changed
+        self.hashes = {}
+        self.bad_files = {}
+        self.pool = WordPool()
+        self.recipes = []
+        self.recipe_files = []
+        self.masks = []
+        self.wordlists = []
+        self.wordlist_files = []
+
+
+def _statDataFiles():
+    """Get the stats used to tell if a file has changed, for every data file.
+
+    Returns a dictionary of (modified time, size) tuples, keyed by path.
+    Files removed while they are being looked at are left out.
+    """
+    stats = {}
+    paths = listDataFiles(STORY_DIR, ".story") + \
+        listDataFiles(WORDS_DIR, ".words")
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        stats[path] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+def _fileHash(path):
+    """Get the CRC-32 checksum of a file's bytes."""
+    with open(path, 'rb') as file:
+        return zlib.crc32(file.read())
+
+
+def _corpusVersion(hashes):
+    """Get the CRC-32 of every file's name and checksum, in order."""
+    text = ""
+    for path in sorted(hashes):
+        text += "%s:%08x\n" % (os.path.basename(path), hashes[path])
+    return zlib.crc32(text.encode())
+
+
+def _pathsWith(stats, extension):
+    """Get the sorted paths in stats which end with extension."""
+    return sorted(path for path in stats if path.endswith(extension))